@@ -6,6 +6,26 @@ import pulumi_aws_apigateway as apigateway
 config = pulumi.Config()
 db_user = config.require("db_user")
 db_password = config.require_secret("db_password")
+# sends only go to the cache and a redis stream, which a scheduled lambda drains into the DB (lambda/outbox.py)
+write_behind = config.get_bool("write_behind") or False
+# every invocation logs the milliseconds of its phases and its round trips as metrics (lambda/tracing.py)
+tracing = config.get_bool("tracing") or False
+# one lambda serves all the endpoints, so they share warm containers and connections (lambda/router_handler.py)
+single_function = config.get_bool("single_function") or False
+# read_messages may wait this long for new messages (long polling, lambda/cache.py). at most 25 - an API gateway
+# request times out after 29 seconds
+long_poll_seconds = min(config.get_int("long_poll_seconds") or 0, 25)
+# the lambdas which serve read_messages wait that long on top of their work
+read_timeout = long_poll_seconds + 10 if long_poll_seconds else None
+# the months of messages kept in the DB, 0 - forever. expired months are dropped, or with retention_archive
+# moved into tables of their own (lambda/retention.py)
+retention_months = config.get_int("retention_months") or 0
+retention_archive = config.get_bool("retention_archive") or False
+# the cached lists of the format before the sorted sets are read until this time (epoch seconds, lambda/cache.py):
+# set once, at the first deploy of the sorted sets, to that time plus a day. unset - they are not read
+legacy_lists_until = config.get_int("legacy_lists_until") or 0
+# the handlers, archived from the lambda directory on every deploy - so the deployed code is always the tree's
+lambda_code = pulumi.FileArchive("./lambda")
 cache_port = 6379
 db_port = 3306
 
@@ -142,26 +162,72 @@ def create_lambda_security(vpc_id, subnets_ids):
     return vpc_config
 
 
-def create_lambda(file_name, function_name, role, vpc_config, variables=None):
+def create_lambda(file_name, function_name, role, vpc_config, variables=None, paths=None, timeout=None):
+    # paths: the endpoints the function serves (by default /{function_name}). timeout: seconds (default 3)
     # lambda function
     fn = aws.lambda_.Function(f"{function_name}_fn",
                               runtime="python3.12",
                               handler=f"{file_name}_handler.{function_name}_lambda",
                               role=role.arn,
-                              code=pulumi.FileArchive("lambda.zip"),
+                              code=lambda_code,
                               vpc_config=vpc_config,
+                              timeout=timeout,
                               environment=aws.lambda_.FunctionEnvironmentArgs(variables=variables),
                               )
 
     api = apigateway.RestAPI(f"{function_name}_api",
                              routes=[
-                                 apigateway.RouteArgs(path=f"/{function_name}", method=apigateway.Method.POST,
+                                 apigateway.RouteArgs(path=f"/{path}", method=apigateway.Method.POST,
                                                       event_handler=fn)
+                                 for path in (paths or [function_name])
                              ])
 
     pulumi.export(f"{function_name}_url:", api.url)
 
 
+def create_deploy_task(file_name, function_name, role, vpc_config, variables=None, depends_on=None):
+    # lambda function which is run once on every deploy of new code, before users hit the other lambdas
+    fn = aws.lambda_.Function(f"{function_name}_fn",
+                              runtime="python3.12",
+                              handler=f"{file_name}_handler.{function_name}_lambda",
+                              role=role.arn,
+                              code=lambda_code,
+                              vpc_config=vpc_config,
+                              timeout=60,
+                              environment=aws.lambda_.FunctionEnvironmentArgs(variables=variables),
+                              )
+
+    invocation = aws.lambda_.Invocation(f"{function_name}_invocation",
+                                        function_name=fn.name,
+                                        input=json.dumps({}),
+                                        triggers={"source_code_hash": fn.source_code_hash},
+                                        opts=pulumi.ResourceOptions(depends_on=depends_on))
+
+    return invocation
+
+
+def create_scheduled_lambda(file_name, function_name, role, vpc_config, variables=None, schedule="rate(1 minute)"):
+    # lambda function which runs on a schedule, one at a time
+    fn = aws.lambda_.Function(f"{function_name}_fn",
+                              runtime="python3.12",
+                              handler=f"{file_name}_handler.{function_name}_lambda",
+                              role=role.arn,
+                              code=lambda_code,
+                              vpc_config=vpc_config,
+                              timeout=60,
+                              reserved_concurrent_executions=1,
+                              environment=aws.lambda_.FunctionEnvironmentArgs(variables=variables),
+                              )
+
+    rule = aws.cloudwatch.EventRule(f"{function_name}_schedule", schedule_expression=schedule)
+    _ = aws.cloudwatch.EventTarget(f"{function_name}_target", rule=rule.name, arn=fn.arn)
+    _ = aws.lambda_.Permission(f"{function_name}_permission",
+                               action="lambda:InvokeFunction",
+                               function=fn.name,
+                               principal="events.amazonaws.com",
+                               source_arn=rule.arn)
+
+
 def create_cache(vpc_id, subnets_ids):
     # Create a security group for ElastiCache
     security_group = aws.ec2.SecurityGroup(
@@ -257,23 +323,52 @@ lambda_vpc_config = create_lambda_security(network_vpc_id, network_subnets_ids)
 env_variables = {"REDIS_HOST": redis.primary_endpoint_address,
                  "DB_HOST": aurora.endpoint,
                  "DB_USER": db_user,
-                 "DB_PASS": db_password
+                 "DB_PASS": db_password,
+                 "WRITE_BEHIND": "1" if write_behind else "0",
+                 "TRACING": "1" if tracing else "0",
+                 "LONG_POLL_SECONDS": str(long_poll_seconds),
+                 "RETENTION_MONTHS": str(retention_months),
+                 "RETENTION_ARCHIVE": "1" if retention_archive else "0",
+                 "LEGACY_LISTS_UNTIL": str(legacy_lists_until)
                  }
 
-create_lambda("user", "register", lambda_role, lambda_vpc_config, variables=env_variables)
-# https://syobzgg5p3.execute-api.eu-west-3.amazonaws.com/stage/register?user_name=shir
-create_lambda("user", "block", lambda_role, lambda_vpc_config, variables=env_variables)
-# https://xpg36smji6.execute-api.eu-west-3.amazonaws.com/stage/block?blocking_user_id=7ad43600-fb44-4572-b0df-24dd2ffba3fe&blocked_user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&to_block=1
-create_lambda("user", "send", lambda_role, lambda_vpc_config, variables=env_variables)
-# https://i1d1chc91e.execute-api.eu-west-3.amazonaws.com/stage/send?sending_user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&receiving_user_id=7ad43600-fb44-4572-b0df-24dd2ffba3fe&message_text=hi
-
-create_lambda("group", "create_group", lambda_role, lambda_vpc_config, variables=env_variables)
-# https://462jh7fvn2.execute-api.eu-west-3.amazonaws.com/stage/create_group?group_name=bambis
-create_lambda("group", "update_group", lambda_role, lambda_vpc_config, variables=env_variables)
-# https://vc2jjop2c7.execute-api.eu-west-3.amazonaws.com/stage/update_group?user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&group_id=8357cda7-6b68-4b66-b07b-60647eca717c&to_be_added=1
-create_lambda("group", "send_group", lambda_role, lambda_vpc_config, variables=env_variables)
-# https://x9g5o3hfqa.execute-api.eu-west-3.amazonaws.com/stage/send_group?sending_user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&group_id=8357cda7-6b68-4b66-b07b-60647eca717c&message_text=hello_group
-
-create_lambda("read", "read_messages", lambda_role, lambda_vpc_config, variables=env_variables)
-# https://prefcdtqm0.execute-api.eu-west-3.amazonaws.com/stage/read_messages?user_id=7ad43600-fb44-4572-b0df-24dd2ffba3fe&min_timestamp=2024-07-01 15:31:00.0
+# applies the DB schema migrations (lambda/schema.py)
+migration = create_deploy_task("schema", "migrate", lambda_role, lambda_vpc_config, variables=env_variables)
+# loads the block list into the cache (lambda/blocks.py)
+create_deploy_task("user", "rebuild_blocks", lambda_role, lambda_vpc_config, variables=env_variables,
+                   depends_on=[migration])
+# partitions the next months of the messages tables, drops (or archives) the expired ones
+create_scheduled_lambda("retention", "maintain", lambda_role, lambda_vpc_config, variables=env_variables,
+                        schedule="rate(1 day)")
+if write_behind:
+    # inserts the messages sent into the DB
+    create_scheduled_lambda("drain", "drain", lambda_role, lambda_vpc_config, variables=env_variables)
+
+if single_function:
+    create_lambda("router", "route", lambda_role, lambda_vpc_config, variables=env_variables,
+                  paths=["register", "block", "send", "send_batch", "create_group", "update_group", "send_group",
+                         "read_messages", "inbox_summary"],
+                  timeout=read_timeout)
+else:
+    create_lambda("user", "register", lambda_role, lambda_vpc_config, variables=env_variables)
+    # https://syobzgg5p3.execute-api.eu-west-3.amazonaws.com/stage/register?user_name=shir
+    create_lambda("user", "block", lambda_role, lambda_vpc_config, variables=env_variables)
+    # https://xpg36smji6.execute-api.eu-west-3.amazonaws.com/stage/block?blocking_user_id=7ad43600-fb44-4572-b0df-24dd2ffba3fe&blocked_user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&to_block=1
+    create_lambda("user", "send", lambda_role, lambda_vpc_config, variables=env_variables)
+    # https://i1d1chc91e.execute-api.eu-west-3.amazonaws.com/stage/send?sending_user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&receiving_user_id=7ad43600-fb44-4572-b0df-24dd2ffba3fe&message_text=hi
+    create_lambda("user", "send_batch", lambda_role, lambda_vpc_config, variables=env_variables)
+    # body: [{"sending_user_id": "3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d", "receiving_user_id": "7ad43600-fb44-4572-b0df-24dd2ffba3fe", "message_text": "hi"}]
+
+    create_lambda("group", "create_group", lambda_role, lambda_vpc_config, variables=env_variables)
+    # https://462jh7fvn2.execute-api.eu-west-3.amazonaws.com/stage/create_group?group_name=bambis
+    create_lambda("group", "update_group", lambda_role, lambda_vpc_config, variables=env_variables)
+    # https://vc2jjop2c7.execute-api.eu-west-3.amazonaws.com/stage/update_group?user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&group_id=8357cda7-6b68-4b66-b07b-60647eca717c&to_be_added=1
+    create_lambda("group", "send_group", lambda_role, lambda_vpc_config, variables=env_variables)
+    # https://x9g5o3hfqa.execute-api.eu-west-3.amazonaws.com/stage/send_group?sending_user_id=3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d&group_id=8357cda7-6b68-4b66-b07b-60647eca717c&message_text=hello_group
+
+    create_lambda("read", "read_messages", lambda_role, lambda_vpc_config, variables=env_variables,
+                  timeout=read_timeout)
+    # https://prefcdtqm0.execute-api.eu-west-3.amazonaws.com/stage/read_messages?user_id=7ad43600-fb44-4572-b0df-24dd2ffba3fe&min_timestamp=2024-07-01 15:31:00.0
+    create_lambda("read", "inbox_summary", lambda_role, lambda_vpc_config, variables=env_variables)
+    # body: {"total": 3, "users": {"3bf3d96c-2cc9-42b4-ab74-a05ba1d21b0d": 1}, "groups": {"8357cda7-6b68-4b66-b07b-60647eca717c": 2}}
 
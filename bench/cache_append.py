@@ -0,0 +1,56 @@
+"""Fan-out of one group message to the cache: per-member LPUSH/LLEN/RPOP vs a single pipeline.
+
+Run from the project root:  python bench/cache_append.py [--repeat 20] [--cache-rtt-ms 0.5]
+"""
+import argparse
+
+import common
+import fakes
+import cache
+import codec
+
+
+def append_one_by_one(client, receiving_user_ids, value):
+    # what send_group did before the pipeline: up to three round trips per member
+    for receiving_user_id in receiving_user_ids:
+        client.lpush(receiving_user_id, value)
+        if client.llen(receiving_user_id) > cache.cache_length:
+            client.rpop(receiving_user_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--cache-rtt-ms', type=float, default=0.5)
+    args = parser.parse_args()
+
+    server = fakes.FakeRedisServer(args.cache_rtt_ms / 1000)
+    client = fakes.FakeRedis(fakes.FakeConnectionPool(server, {}))
+    value = '2024-07-01 09:00:00.000000:: 1 sender:: hello_group'
+    score = 1719824400000000
+    record = codec.encode(score, 1, '7ad43600-fb44-4572-b0df-24dd2ffba3fe', 'hello_group')
+
+    print(f'{"members":>8}{"loop ms":>12}{"loop rtt":>10}{"pipeline ms":>14}{"pipeline rtt":>14}{"speedup":>10}')
+    for group_size in (10, 100, 1000):
+        members = [f'user-{i}' for i in range(group_size)]
+        for member in members:
+            # full caches, so the loop pays for the RPOP as well
+            server.data[member.encode()] = [value.encode()] * cache.cache_length
+            server.data[cache.user_messages_key(member).encode()] = {
+                codec.encode(score - i, 1, '7ad43600-fb44-4572-b0df-24dd2ffba3fe', 'hello_group'): score - i
+                for i in range(1, cache.cache_length + 1)}
+
+        rtt = server.round_trips.count
+        loop = common.summary(common.timed(lambda: append_one_by_one(client, members, value), args.repeat))
+        loop_rtt = (server.round_trips.count - rtt) / args.repeat
+
+        rtt = server.round_trips.count
+        pipe = common.summary(common.timed(lambda: cache.append_messages(client, members, record, score), args.repeat))
+        pipe_rtt = (server.round_trips.count - rtt) / args.repeat
+
+        print(f'{group_size:>8}{loop["mean_ms"]:>12.2f}{loop_rtt:>10.0f}{pipe["mean_ms"]:>14.2f}{pipe_rtt:>14.0f}'
+              f'{loop["mean_ms"] / pipe["mean_ms"]:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import os
+import statistics
+import sys
+import time
+
+# the handlers are deployed from the lambda directory and import each other as top-level modules
+lambda_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+if lambda_dir not in sys.path:
+    sys.path.insert(0, lambda_dir)
+
+for name, value in (('DB_HOST', 'localhost'), ('DB_USER', 'bench'), ('DB_PASS', 'bench'),
+                    ('REDIS_HOST', 'localhost')):
+    os.environ.setdefault(name, value)
+
+
+def make_event(**params):
+    # the part of an API Gateway proxy event the handlers read
+    return {'queryStringParameters': {key: str(value) for key, value in params.items()}}
+
+
+def timed(fn, repeat, before=None):
+    # wall-clock milliseconds of each call
+    samples = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summary(samples):
+    percentiles = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {'mean_ms': statistics.fmean(samples), 'p50_ms': statistics.median(samples),
+            'p95_ms': percentiles[94], 'p99_ms': percentiles[98]}
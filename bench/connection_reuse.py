@@ -0,0 +1,71 @@
+"""Per-invocation latency of every handler with and without warm-container connection reuse.
+
+Run from the project root:  python bench/connection_reuse.py [--repeat 200] [--db-rtt-ms 1] [--cache-rtt-ms 0.5]
+"""
+import argparse
+import uuid
+
+import common
+import fakes
+import resources
+import group_handler
+import read_handler
+import user_handler
+
+
+def handlers():
+    user, other, group, third = (str(uuid.UUID(int=i)) for i in range(4))
+    return [
+        ('register', user_handler.register_lambda, common.make_event(user_name='shir')),
+        ('block', user_handler.block_lambda,
+         common.make_event(blocking_user_id=user, blocked_user_id=third, to_block=1)),
+        ('send', user_handler.send_lambda,
+         common.make_event(sending_user_id=other, receiving_user_id=user, message_text='hi')),
+        ('create_group', group_handler.create_group_lambda, common.make_event(group_name='bambis')),
+        ('update_group', group_handler.update_group_lambda,
+         common.make_event(user_id=user, group_id=group, to_be_added=1)),
+        ('send_group', group_handler.send_group_lambda,
+         common.make_event(sending_user_id=other, group_id=group, message_text='hello_group')),
+        ('read_messages', read_handler.read_messages_lambda,
+         common.make_event(user_id=user, min_timestamp='2024-07-01 09:00:00.0')),
+    ]
+
+
+def members_responder(query, args):
+    if 'group_members_table' in query and query.lstrip().startswith('SELECT user_id'):
+        return [(str(uuid.UUID(int=i)),) for i in range(10)]
+    return ()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--db-rtt-ms', type=float, default=1.0)
+    parser.add_argument('--cache-rtt-ms', type=float, default=0.5)
+    args = parser.parse_args()
+
+    db = fakes.FakeMySQLServer(args.db_rtt_ms / 1000, responder=members_responder)
+    cache = fakes.FakeRedisServer(args.cache_rtt_ms / 1000)
+    fakes.install(resources, db, cache)
+
+    print(f'{"handler":<15}{"cold ms":>10}{"reused ms":>12}{"speedup":>10}{"connects/inv":>15}')
+    for name, handler, event in handlers():
+        def invoke():
+            response = handler(event, None)
+            assert response['statusCode'] == 200, response
+
+        resources.close_all()
+        connections = db.connections + cache.connections
+        cold = common.summary(common.timed(invoke, args.repeat, before=resources.close_all))
+        cold_connects = (db.connections + cache.connections - connections) / args.repeat
+
+        resources.close_all()
+        invoke()  # open the shared connections once, as the first (cold) invocation would
+        warm = common.summary(common.timed(invoke, args.repeat))
+
+        print(f'{name:<15}{cold["mean_ms"]:>10.2f}{warm["mean_ms"]:>12.2f}'
+              f'{cold["mean_ms"] / warm["mean_ms"]:>9.1f}x{cold_connects:>10.1f} -> 0')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Fails (exit code 1) if the read_messages DB query falls back to a full table scan.
+
+Needs a real MySQL-compatible server (DB_HOST / DB_USER / DB_PASS). The check runs in a scratch
+database which is migrated, filled with synthetic rows and dropped at the end.
+
+Run from the project root:  python bench/explain_read.py [--rows 5000]
+"""
+import argparse
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+import common  # noqa: F401 (sets up the import path)
+import ids
+import pymysql
+import read_handler
+import resources
+import schema
+
+
+def seed(cursor, rows):
+    users = [str(uuid.uuid4()) for _ in range(100)]
+    groups = [str(uuid.uuid4()) for _ in range(20)]
+    start = datetime(2024, 7, 1)
+    cursor.executemany('INSERT INTO group_members_table (group_id, user_id) VALUES (%s, %s)',
+                       [(group, user) for i, group in enumerate(groups) for user in users[i::7]])
+    cursor.executemany(
+        'INSERT INTO user_messages_table (message_id, sending_user_id, receiving_user_id, message_text, timestamp) '
+        'VALUES (%s, %s, %s, %s, %s)',
+        [(ids.to_bytes(ids.new_id()), users[i % 100], users[(i * 7) % 100], 'hi', start + timedelta(seconds=i))
+         for i in range(rows)])
+    cursor.executemany(
+        'INSERT INTO group_messages_table (message_id, sending_user_id, group_id, message_text, timestamp) '
+        'VALUES (%s, %s, %s, %s, %s)',
+        [(ids.to_bytes(ids.new_id()), users[i % 100], groups[i % 20], 'hello', start + timedelta(seconds=i))
+         for i in range(rows)])
+    for table in ('group_members_table', 'user_messages_table', 'group_messages_table'):
+        cursor.execute(f'ANALYZE TABLE {table}')
+    return users[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--database', default='explain_read_check')
+    args = parser.parse_args()
+
+    schema.db_name = args.database
+    connection = resources.get_db_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            user_id = seed(cursor, args.rows)
+            cursor.execute('EXPLAIN ' + read_handler.db_read_query,
+                           {'user_id': user_id, 'min_timestamp': '2024-07-01 01:00:00.0'})
+            plan = cursor.fetchall()
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE {args.database}')
+        resources.close_all()
+
+    full_scans = []
+    for row in plan:
+        print(f'{row["table"]:<28}{row["type"] or "":<10}{row["key"] or "":<32}{row["rows"]}')
+        # <unionN,M> is the (in-memory) result of the UNION itself, not a table
+        if row['type'] == 'ALL' and not row['table'].startswith('<'):
+            full_scans.append(row['table'])
+
+    if full_scans:
+        print(f'full table scan on: {", ".join(full_scans)}')
+        sys.exit(1)
+    print('ok: no full table scans')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,616 @@
+"""In-process stand-ins for Aurora (pymysql) and ElastiCache (redis) used by the benchmarks.
+
+Every request that would cross the network costs one simulated round trip, so the numbers
+reflect how many round trips a handler makes rather than how fast a real server is.
+"""
+import fnmatch
+import threading
+import time
+
+
+class RoundTrips:
+    def __init__(self, rtt_seconds):
+        self.rtt_seconds = rtt_seconds
+        self.count = 0
+
+    def wait(self, n=1):
+        self.count += n
+        if self.rtt_seconds:
+            time.sleep(self.rtt_seconds * n)
+
+
+class _Proxy:
+    # the real module with a few attributes replaced
+    def __init__(self, module, **overrides):
+        self._module = module
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+# ----------------------------------------------------------------------------------------------
+# database
+# ----------------------------------------------------------------------------------------------
+
+class FakeCursor:
+    max_stmt_length = 1024000  # pymysql.cursors.Cursor.max_stmt_length
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = ()
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, args=None):
+        server = self.connection.server
+        server.round_trips.wait()
+        server.queries.append(query)
+        self._rows = tuple(server.respond(query, args))
+        self.rowcount = len(self._rows)
+        return self.rowcount
+
+    def executemany(self, query, args):
+        # pymysql rewrites INSERT ... VALUES into multi-row statements of up to max_stmt_length bytes
+        args = list(args)
+        server = self.connection.server
+        size = len(query) + sum(len(repr(row)) for row in args)
+        server.round_trips.wait(-(-size // self.max_stmt_length))
+        server.queries.append(query)
+        for row in args:
+            server.respond(query, row)
+        self._rows = ()
+        self.rowcount = len(args)
+        return self.rowcount
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, server, kwargs):
+        self.server = server
+        self.kwargs = kwargs
+        self.open = True
+        server.round_trips.wait(server.connect_round_trips)
+        server.connections += 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=True):
+        self.server.round_trips.wait()
+        if not self.open and reconnect:
+            self.server.round_trips.wait(self.server.connect_round_trips)
+            self.server.connections += 1
+            self.open = True
+
+    def select_db(self, db):
+        self.server.round_trips.wait()
+
+    def begin(self):
+        self.server.round_trips.wait()
+
+    def commit(self):
+        self.server.round_trips.wait()
+
+    def rollback(self):
+        self.server.round_trips.wait()
+
+    def close(self):
+        self.open = False
+
+
+class FakeMySQLServer:
+    # TCP handshake, server greeting, auth and the final OK packet
+    connect_round_trips = 4
+
+    def __init__(self, rtt_seconds=0.001, responder=None):
+        self.round_trips = RoundTrips(rtt_seconds)
+        self.responder = responder or (lambda query, args: ())
+        self.queries = []
+        self.connections = 0
+        self.schema_version = 0
+
+    def connect(self, **kwargs):
+        return FakeConnection(self, kwargs)
+
+    def respond(self, query, args):
+        # just enough of the schema bookkeeping for the migrations to run once
+        if 'MAX(version)' in query:
+            return [(self.schema_version,)]
+        if 'GET_LOCK' in query or 'RELEASE_LOCK' in query:
+            return [(1,)]
+        if query.startswith('INSERT INTO schema_version'):
+            self.schema_version = args[0]
+            return ()
+        return self.responder(query, args)
+
+
+# ----------------------------------------------------------------------------------------------
+# cache
+# ----------------------------------------------------------------------------------------------
+
+def _b(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class FakeRedisServer:
+    connect_round_trips = 1
+
+    def __init__(self, rtt_seconds=0.0005):
+        self.round_trips = RoundTrips(rtt_seconds)
+        self.data = {}
+        self.ttl = {}
+        self.connections = 0
+        # one command (or pipeline) at a time, as on the single-threaded server. notified after each, for the
+        # blocking commands
+        self.changed = threading.Condition()
+
+    def call(self, command, *args, **kwargs):
+        with self.changed:
+            result = getattr(self, 'cmd_' + command)(*args, **kwargs)
+            self.changed.notify_all()
+            return result
+
+    # keys
+    def cmd_ping(self):
+        return True
+
+    def cmd_time(self):
+        now = time.time()
+        return int(now), int(now % 1 * 1_000_000)
+
+    def cmd_delete(self, *keys):
+        removed = 0
+        for key in keys:
+            removed += self.data.pop(_b(key), None) is not None
+            self.ttl.pop(_b(key), None)
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(_b(key) in self.data for key in keys)
+
+    def cmd_expire(self, key, seconds):
+        if _b(key) not in self.data:
+            return False
+        self.ttl[_b(key)] = seconds
+        return True
+
+    def cmd_scan_iter(self, match=None, count=None):
+        # all at once, where the client would SCAN in batches
+        return [key for key in list(self.data) if match is None or fnmatch.fnmatchcase(key, _b(match))]
+
+    # strings
+    def cmd_set(self, key, value, nx=False, px=None):
+        if nx and _b(key) in self.data:
+            return None
+        self.data[_b(key)] = _b(value)
+        if px is not None:
+            self.ttl[_b(key)] = px / 1000
+        return True
+
+    def cmd_get(self, key):
+        return self.data.get(_b(key))
+
+    def cmd_incrby(self, key, amount=1):
+        value = int(self.data.get(_b(key), 0)) + amount
+        self.data[_b(key)] = _b(value)
+        return value
+
+    # lists
+    def cmd_lpush(self, key, *values):
+        items = self.data.setdefault(_b(key), [])
+        for value in values:
+            items.insert(0, _b(value))
+        return len(items)
+
+    def cmd_rpop(self, key):
+        items = self.data.get(_b(key))
+        if not items:
+            return None
+        value = items.pop()
+        if not items:
+            self.cmd_delete(key)
+        return value
+
+    def cmd_blpop(self, keys, timeout=0):
+        # waiting releases self.changed (held by call), so other clients can push meanwhile
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            for key in keys:
+                items = self.data.get(_b(key))
+                if items:
+                    value = items.pop(0)
+                    if not items:
+                        self.cmd_delete(key)
+                    return [_b(key), value]
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.changed.wait(remaining)
+
+    def cmd_llen(self, key):
+        return len(self.data.get(_b(key), []))
+
+    def cmd_lrange(self, key, start, end):
+        items = self.data.get(_b(key), [])
+        end = len(items) if end == -1 else end + 1
+        return list(items[start:end])
+
+    def cmd_ltrim(self, key, start, end):
+        items = self.data.get(_b(key))
+        if items is not None:
+            end = len(items) if end == -1 else end + 1
+            items[:] = items[start:end]
+            if not items:
+                self.cmd_delete(key)
+        return True
+
+    # sets
+    def cmd_sadd(self, key, *members):
+        items = self.data.setdefault(_b(key), set())
+        before = len(items)
+        items.update(_b(member) for member in members)
+        return len(items) - before
+
+    def cmd_srem(self, key, *members):
+        items = self.data.get(_b(key), set())
+        before = len(items)
+        items.difference_update(_b(member) for member in members)
+        if not items:
+            self.cmd_delete(key)
+        return before - len(items)
+
+    def cmd_smembers(self, key):
+        return set(self.data.get(_b(key), set()))
+
+    def cmd_sismember(self, key, member):
+        return _b(member) in self.data.get(_b(key), set())
+
+    def cmd_smismember(self, key, members):
+        return [int(self.cmd_sismember(key, member)) for member in members]
+
+    # hashes
+    def cmd_hincrby(self, key, field, amount=1):
+        items = self.data.setdefault(_b(key), {})
+        value = int(items.get(_b(field), 0)) + amount
+        items[_b(field)] = _b(value)
+        return value
+
+    def cmd_hset(self, key, field=None, value=None, mapping=None):
+        items = self.data.setdefault(_b(key), {})
+        mapping = dict(mapping or {})
+        if field is not None:
+            mapping[field] = value
+        added = sum(_b(field) not in items for field in mapping)
+        items.update((_b(field), _b(value)) for field, value in mapping.items())
+        return added
+
+    def cmd_hdel(self, key, *fields):
+        items = self.data.get(_b(key), {})
+        deleted = sum(items.pop(_b(field), None) is not None for field in fields)
+        if not items:
+            self.data.pop(_b(key), None)
+        return deleted
+
+    def cmd_hgetall(self, key):
+        return dict(self.data.get(_b(key), {}))
+
+    def cmd_hmget(self, key, fields):
+        items = self.data.get(_b(key), {})
+        return [items.get(_b(field)) for field in fields]
+
+    # Bloom filters (RedisBloom), exact here - a set of the items
+    def cmd_bf_reserve(self, key, error_rate, capacity):
+        self.data.setdefault(_b(key), set())
+        return True
+
+    def cmd_bf_add(self, key, item):
+        return self.cmd_sadd(key, item) == 1
+
+    def cmd_bf_madd(self, key, *items):
+        return [self.cmd_bf_add(key, item) for item in items]
+
+    def cmd_bf_exists(self, key, item):
+        return self.cmd_sismember(key, item)
+
+    def cmd_bf_mexists(self, key, *items):
+        return [self.cmd_bf_exists(key, item) for item in items]
+
+    # sorted sets (member -> score, ordered on demand)
+    def _zsorted(self, key):
+        return sorted(self.data.get(_b(key), {}).items(), key=lambda item: (item[1], item[0]))
+
+    @staticmethod
+    def _zresult(items, withscores, score_cast_func):
+        if withscores:
+            return [(member, score_cast_func(score)) for member, score in items]
+        return [member for member, _ in items]
+
+    @staticmethod
+    def _zbound(value):
+        return float(value.lstrip('(')) if isinstance(value, str) else value
+
+    def cmd_zadd(self, key, mapping, lt=False, gt=False):
+        items = self.data.setdefault(_b(key), {})
+        added = 0
+        for member, score in mapping.items():
+            current = items.get(_b(member))
+            added += current is None
+            if current is None or (not lt or score < current) and (not gt or score > current):
+                items[_b(member)] = score
+        return added
+
+    def cmd_zscore(self, key, member):
+        return self.data.get(_b(key), {}).get(_b(member))
+
+    def cmd_zmscore(self, key, members):
+        return [self.cmd_zscore(key, member) for member in members]
+
+    def cmd_zcard(self, key):
+        return len(self.data.get(_b(key), {}))
+
+    def cmd_zremrangebyrank(self, key, start, end):
+        ordered = self._zsorted(key)
+        end = len(ordered) + end + 1 if end < 0 else end + 1
+        start = len(ordered) + start if start < 0 else start
+        removed = ordered[max(start, 0):max(end, 0)]
+        for member, _ in removed:
+            del self.data[_b(key)][member]
+        if _b(key) in self.data and not self.data[_b(key)]:
+            self.cmd_delete(key)
+        return len(removed)
+
+    def cmd_zrange(self, key, start, end, withscores=False, score_cast_func=float):
+        ordered = self._zsorted(key)
+        end = len(ordered) if end == -1 else end + 1
+        return self._zresult(ordered[start:end], withscores, score_cast_func)
+
+    def cmd_zrevrangebyscore(self, key, max, min, withscores=False, score_cast_func=float):
+        return self.cmd_zrangebyscore(key, min, max, withscores, score_cast_func)[::-1]
+
+    def cmd_zrangebyscore(self, key, min, max, withscores=False, score_cast_func=float):
+        low, high = self._zbound(min), self._zbound(max)
+        low_open, high_open = str(min).startswith('('), str(max).startswith('(')
+        items = [item for item in self._zsorted(key)
+                 if (low < item[1] if low_open else low <= item[1]) and (item[1] < high if high_open else item[1] <= high)]
+        return self._zresult(items, withscores, score_cast_func)
+
+    def cmd_zrem(self, key, *members):
+        items = self.data.get(_b(key), {})
+        removed = sum(items.pop(_b(member), None) is not None for member in members)
+        if _b(key) in self.data and not items:
+            self.cmd_delete(key)
+        return removed
+
+    # lua scripts - the release of redis.lock.Lock, sequence.incrby_existing_script and
+    # cache.count_group_message_script only
+    def cmd_eval(self, script, numkeys, *keys_and_args):
+        return self.cmd_evalscript(script, keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+    def cmd_evalscript(self, script, keys, args):
+        if 'redis.call(\'del\', KEYS[1])' in script and 'token ~= ARGV[1]' in script:
+            if self.data.get(_b(keys[0])) != _b(args[0]):
+                return 0
+            return self.cmd_delete(keys[0])
+        if 'redis.call(\'EXISTS\', KEYS[1]) == 1' in script and 'INCRBY' in script:
+            return self.cmd_incrby(keys[0], int(args[0])) if self.cmd_exists(keys[0]) else None
+        if 'redis.call(\'HINCRBY\', KEYS[1], ARGV[1], 1)' in script and 'HSET' in script:
+            sent = self.cmd_hincrby(keys[0], args[0], 1)
+            self.cmd_hset(keys[1], args[0], sent)
+            self.cmd_expire(keys[1], int(args[1]))
+            return sent
+        raise NotImplementedError(script)
+
+    # streams (entries in order of their ids, consumer groups with their pending entries)
+    def _stream(self, key):
+        return self.data.setdefault(_b(key), {'entries': {}, 'groups': {}, 'last_id': (0, 0)})
+
+    @staticmethod
+    def _stream_id(entry_id):
+        milliseconds, sequence = _b(entry_id).split(b'-')
+        return int(milliseconds), int(sequence)
+
+    def cmd_xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        stream = self._stream(name)
+        milliseconds = int(time.time() * 1000)
+        last_milliseconds, last_sequence = stream['last_id']
+        entry_id = (milliseconds, 0) if milliseconds > last_milliseconds else (last_milliseconds, last_sequence + 1)
+        stream['last_id'] = entry_id
+        stream['entries'][entry_id] = {_b(key): _b(value) for key, value in fields.items()}
+        if maxlen is not None:
+            # exactly, where the server may keep a few more when approximate
+            for old_id in sorted(stream['entries'])[:-maxlen]:
+                del stream['entries'][old_id]
+        return b'%d-%d' % entry_id
+
+    def cmd_xread(self, streams, count=None, block=None):
+        # the entries after each stream's id. waiting releases self.changed (held by call), as in cmd_blpop
+        deadline = None if not block else time.monotonic() + block / 1000
+        while True:
+            response = []
+            for name, last_id in streams.items():
+                stream = self.data.get(_b(name))
+                start = self._stream_id(last_id)
+                entry_ids = sorted(entry_id for entry_id in stream['entries'] if entry_id > start) if stream else []
+                if entry_ids:
+                    response.append([_b(name), [(b'%d-%d' % entry_id, stream['entries'][entry_id])
+                                                for entry_id in entry_ids[:count]]])
+            if response or block is None:
+                return response
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return response
+            self.changed.wait(remaining)
+
+    def cmd_xlen(self, name):
+        return len(self.data[_b(name)]['entries']) if _b(name) in self.data else 0
+
+    def cmd_xgroup_create(self, name, groupname, id='$', mkstream=False):
+        import redis
+
+        if _b(name) not in self.data and not mkstream:
+            raise redis.exceptions.ResponseError('The XGROUP subcommand requires the key to exist.')
+        stream = self._stream(name)
+        if _b(groupname) in stream['groups']:
+            raise redis.exceptions.ResponseError('BUSYGROUP Consumer Group name already exists')
+        last_delivered = stream['last_id'] if id == '$' else self._stream_id(id if '-' in str(id) else f'{id}-0')
+        stream['groups'][_b(groupname)] = {'last_delivered': last_delivered, 'pending': {}}
+        return True
+
+    def cmd_xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        # never blocks: nothing else could add entries meanwhile
+        response = []
+        for name, last_id in streams.items():
+            stream = self._stream(name)
+            group = stream['groups'][_b(groupname)]
+            if last_id == '>':
+                entry_ids = sorted(entry_id for entry_id in stream['entries'] if entry_id > group['last_delivered'])
+                entry_ids = entry_ids[:count]
+                for entry_id in entry_ids:
+                    group['pending'][entry_id] = [_b(consumername), 1]
+                if entry_ids:
+                    group['last_delivered'] = entry_ids[-1]
+            else:
+                # the consumer's own pending entries (deleted ones without fields)
+                start = self._stream_id(last_id if '-' in str(last_id) else f'{last_id}-0')
+                entry_ids = sorted(entry_id for entry_id, (consumer, _) in group['pending'].items()
+                                   if consumer == _b(consumername) and entry_id > start)[:count]
+                for entry_id in entry_ids:
+                    group['pending'][entry_id][1] += 1
+            entries = [(b'%d-%d' % entry_id, stream['entries'].get(entry_id)) for entry_id in entry_ids]
+            if entries or last_id != '>':
+                response.append([_b(name), entries])
+        return response
+
+    def cmd_xpending_range(self, name, groupname, min, max, count, consumername=None, idle=None):
+        group = self._stream(name)['groups'][_b(groupname)]
+        first = (0, 0) if min == '-' else self._stream_id(min)
+        last = (float('inf'), 0) if max == '+' else self._stream_id(max)
+        entry_ids = sorted(entry_id for entry_id, (consumer, _) in group['pending'].items()
+                           if first <= entry_id <= last
+                           and (consumername is None or _b(consumername) == consumer))[:count]
+        return [{'message_id': b'%d-%d' % entry_id, 'consumer': group['pending'][entry_id][0],
+                 'time_since_delivered': 0, 'times_delivered': group['pending'][entry_id][1]}
+                for entry_id in entry_ids]
+
+    def cmd_xack(self, name, groupname, *ids):
+        group = self._stream(name)['groups'][_b(groupname)]
+        return sum(group['pending'].pop(self._stream_id(entry_id), None) is not None for entry_id in ids)
+
+    def cmd_xdel(self, name, *ids):
+        entries = self._stream(name)['entries']
+        return sum(entries.pop(self._stream_id(entry_id), None) is not None for entry_id in ids)
+
+
+class FakeBloom:
+    # client.bf() / pipeline.bf(): BF.* commands sent through the owner
+    def __init__(self, owner):
+        self.owner = owner
+
+    def __getattr__(self, command):
+        return getattr(self.owner, 'bf_' + command)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+
+    def bf(self):
+        return FakeBloom(self)
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.client.connection_pool.use()
+        server = self.client.connection_pool.server
+        server.round_trips.wait()
+        commands, self.commands = self.commands, []
+        with server.changed:
+            return [server.call(command, *args, **kwargs) for command, args, kwargs in commands]
+
+
+class FakeScript:
+    # what register_script returns: runs the script on the server of the client it is called with
+    def __init__(self, script):
+        self.script = script
+
+    def __call__(self, keys=None, args=None, client=None):
+        return client.evalscript(self.script, list(keys or ()), list(args or ()))
+
+
+class FakeRedis:
+    def __init__(self, connection_pool):
+        self.connection_pool = connection_pool
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        return FakeScript(script)
+
+    def bf(self):
+        return FakeBloom(self)
+
+    def __getattr__(self, command):
+        def call(*args, **kwargs):
+            self.connection_pool.use()
+            server = self.connection_pool.server
+            server.round_trips.wait()
+            return server.call(command, *args, **kwargs)
+        return call
+
+
+class FakeConnectionPool:
+    def __init__(self, server, kwargs):
+        self.server = server
+        self.kwargs = kwargs
+        self.connected = False
+
+    def use(self):
+        if not self.connected:
+            self.server.round_trips.wait(self.server.connect_round_trips)
+            self.server.connections += 1
+            self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+
+def install(resources, db_server, cache_server):
+    """Point the shared resource manager at the stand-ins (and drop any open connections)."""
+    import pymysql
+    import redis
+
+    resources.close_all()
+    resources.pymysql = _Proxy(pymysql, connect=db_server.connect)
+    resources.redis = _Proxy(
+        redis,
+        ConnectionPool=lambda **kwargs: FakeConnectionPool(cache_server, kwargs),
+        Redis=lambda connection_pool=None, **kwargs: FakeRedis(connection_pool)
+    )
@@ -0,0 +1,210 @@
+"""Latency (p50 / p95 / p99), round trips and throughput of every *_lambda handler, written as JSON.
+
+The handlers run in-process on synthetic API Gateway events, by default against the stand-ins of bench/fakes.py
+(which count the round trips). With --backend real they run against the MySQL-compatible server and the Redis
+of DB_HOST / DB_USER / DB_PASS / REDIS_HOST, in a scratch database which is dropped at the end (round trips
+are not counted then).
+
+Run from the project root:  python bench/handlers.py [--repeat 200] [--output FILE] [--compare FORMER_FILE]
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+
+import common
+import fakes
+import cache
+import resources
+import schema
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+batch_size = 20
+
+
+def handler_modules():
+    return [importlib.import_module(os.path.basename(path)[:-3])
+            for path in sorted(glob.glob(os.path.join(common.lambda_dir, '*_handler.py')))]
+
+
+def alternate(event, name):
+    # flip a 0/1 parameter before each call (block / unblock, add / remove), so every call succeeds
+    def before():
+        parameters = event['queryStringParameters']
+        parameters[name] = str(1 - int(parameters[name]))
+    return before
+
+
+def scenarios(evict):
+    """(name, handler, event, before) for every handler - before runs ahead of each call, untimed."""
+    import drain_handler
+    import group_handler
+    import read_handler
+    import retention_handler
+    import router_handler
+    import schema_handler
+    import user_handler
+
+    user, other, group, third = (str(uuid.UUID(int=i)) for i in range(4))
+    # a reader who isn't sent messages meanwhile (or they would outgrow the cache)
+    reader = str(uuid.UUID(int=50))
+    block_event = common.make_event(blocking_user_id=user, blocked_user_id=third, to_block=0)
+    update_event = common.make_event(user_id=third, group_id=group, to_be_added=0)
+    read_event = common.make_event(user_id=reader, min_timestamp='2024-07-01 09:00:00.0')
+    send_event = common.make_event(sending_user_id=other, receiving_user_id=user, message_text='hi')
+    batch = [{'sending_user_id': other, 'receiving_user_id': str(uuid.UUID(int=10 + i)), 'message_text': 'hi'}
+             for i in range(batch_size)]
+    return [
+        ('register', user_handler.register_lambda, common.make_event(user_name='shir'), None),
+        ('block', user_handler.block_lambda, block_event, alternate(block_event, 'to_block')),
+        ('send', user_handler.send_lambda, send_event, None),
+        # the same through the router of single-function mode: the difference is the routing
+        ('send (routed)', router_handler.route_lambda, dict(send_event, resource='/send', path='/send'), None),
+        (f'send_batch ({batch_size})', user_handler.send_batch_lambda, {'body': json.dumps(batch)}, None),
+        ('rebuild_blocks', user_handler.rebuild_blocks_lambda, {}, None),
+        ('create_group', group_handler.create_group_lambda, common.make_event(group_name='bambis'), None),
+        ('update_group', group_handler.update_group_lambda, update_event, alternate(update_event, 'to_be_added')),
+        ('send_group', group_handler.send_group_lambda,
+         common.make_event(sending_user_id=other, group_id=group, message_text='hello_group'), None),
+        ('read_messages (cache)', read_handler.read_messages_lambda, read_event, None),
+        ('read_messages (db)', read_handler.read_messages_lambda, read_event, lambda: evict(reader)),
+        ('inbox_summary', read_handler.inbox_summary_lambda, common.make_event(user_id=user), None),
+        ('migrate', schema_handler.migrate_lambda, {}, None),
+        ('drain', drain_handler.drain_lambda, {'seconds': 0}, None),
+        ('maintain', retention_handler.maintain_lambda, {}, None),
+    ], (user, other, group, reader)
+
+
+def seed(user, other, group, reader):
+    # the members of the group (and a message to read) - through the handlers, so it works on any backend
+    import group_handler
+    import user_handler
+
+    for i in range(10):
+        member = user if i == 0 else str(uuid.UUID(int=100 + i))
+        group_handler.update_group_lambda(common.make_event(user_id=member, group_id=group, to_be_added=1), None)
+    user_handler.send_lambda(common.make_event(sending_user_id=other, receiving_user_id=reader, message_text='hi'),
+                             None)
+
+
+def members_responder(query, args):
+    if query.lstrip().startswith('SELECT user_id') and 'group_members_table' in query:
+        return [(str(uuid.UUID(int=i)),) for i in range(10)]
+    return ()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=common.lambda_dir).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, former_path):
+    with open(former_path) as f:
+        former = json.load(f)['handlers']
+    print(f'\ncompared with {former_path}')
+    print(f'{"handler":<24}{"p50 ms":>16}{"p99 ms":>16}')
+    for name, stats in results.items():
+        if name in former:
+            print(f'{name:<24}'
+                  f'{former[name]["p50_ms"]:>8.2f} {stats["p50_ms"] / former[name]["p50_ms"] - 1:>+6.0%}'
+                  f'{former[name]["p99_ms"]:>9.2f} {stats["p99_ms"] / former[name]["p99_ms"] - 1:>+6.0%}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--backend', choices=('fakes', 'real'), default='fakes')
+    parser.add_argument('--db-rtt-ms', type=float, default=1.0, help='fakes only')
+    parser.add_argument('--cache-rtt-ms', type=float, default=0.5, help='fakes only')
+    parser.add_argument('--database', default='handlers_bench', help='real only: the scratch database')
+    parser.add_argument('--output', help=f'default: {results_dir}/handlers-<time>.json')
+    parser.add_argument('--compare', help='a former output, to print the changes')
+    args = parser.parse_args()
+
+    if args.backend == 'fakes':
+        db = fakes.FakeMySQLServer(args.db_rtt_ms / 1000, responder=members_responder)
+        cache_server = fakes.FakeRedisServer(args.cache_rtt_ms / 1000)
+        fakes.install(resources, db, cache_server)
+
+        def evict(user_id):
+            cache_server.cmd_delete(cache.user_messages_key(user_id), cache.last_delivered_key(user_id))
+
+        def round_trips():
+            return db.round_trips.count, cache_server.round_trips.count
+    else:
+        db = None
+        schema.db_name = args.database
+
+        def evict(user_id):
+            resources.get_cache_client().delete(cache.user_messages_key(user_id),
+                                                cache.last_delivered_key(user_id))
+
+        def round_trips():
+            return None, None
+
+    runs, seed_ids = scenarios(evict)
+    covered = {handler for _, handler, _, _ in runs}
+    for module in handler_modules():
+        for name in dir(module):
+            if name.endswith('_lambda') and getattr(module, name) not in covered:
+                print(f'warning: no scenario for {module.__name__}.{name}')
+
+    results = {}
+    try:
+        seed(*seed_ids)
+        print(f'{"handler":<24}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"req/s":>9}{"db rtt":>8}{"cache rtt":>11}')
+        for name, handler, event, before in runs:
+            def invoke():
+                response = handler(event, None)
+                assert response['statusCode'] == 200, (name, response)
+
+            if before is not None:
+                before()
+            invoke()  # warm (connections, cached state)
+            db_before, cache_before = round_trips()
+            samples = common.timed(invoke, args.repeat, before=before)
+            db_after, cache_after = round_trips()
+            stats = common.summary(samples)
+            stats['throughput_rps'] = args.repeat / (sum(samples) / 1000)
+            stats['db_round_trips'] = None if db_after is None else (db_after - db_before) / args.repeat
+            stats['cache_round_trips'] = None if cache_after is None else (cache_after - cache_before) / args.repeat
+            results[name] = stats
+            rtt = ('{:>8.1f}{:>11.1f}'.format(stats['db_round_trips'], stats['cache_round_trips'])
+                   if db_after is not None else f'{"-":>8}{"-":>11}')
+            print(f'{name:<24}{stats["p50_ms"]:>9.2f}{stats["p95_ms"]:>9.2f}{stats["p99_ms"]:>9.2f}'
+                  f'{stats["throughput_rps"]:>9.0f}{rtt}')
+    finally:
+        if db is None:
+            with resources.get_db_connection().cursor() as cursor:
+                cursor.execute(f'DROP DATABASE {args.database}')
+            resources.get_cache_client().flushdb()
+        resources.close_all()
+
+    output = args.output or os.path.join(results_dir, f'handlers-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'git_commit': git_commit(),
+                     'python': platform.python_version(), 'backend': args.backend, 'repeat': args.repeat,
+                     'db_rtt_ms': args.db_rtt_ms if args.backend == 'fakes' else None,
+                     'cache_rtt_ms': args.cache_rtt_ms if args.backend == 'fakes' else None,
+                     'argv': sys.argv[1:]},
+            'handlers': results,
+        }, f, indent=2)
+    print(f'\nwritten to {output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Polling read_messages vs long polling: invocations per reader and the delay until a message is read.
+
+Readers (threads) poll read_messages while a sender sends each of them a message every --gap seconds on average
+(at random). Time runs --speedup times faster than real time, so a simulated minute takes a few seconds.
+
+Run from the project root:  python bench/long_poll.py [--readers 10] [--minutes 2] [--gap 20] [--wait 20] [--speedup 20]
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import common
+import fakes
+import cache
+import codec
+import resources
+import read_handler
+import user_handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=10)
+    parser.add_argument('--minutes', type=float, default=2, help='simulated')
+    parser.add_argument('--gap', type=float, default=20, help='mean seconds between the messages to a reader')
+    parser.add_argument('--wait', type=float, default=20, help='seconds a long poll waits')
+    parser.add_argument('--speedup', type=float, default=20)
+    args = parser.parse_args()
+    scale = 1 / args.speedup
+
+    print(f'{"mode":<22}{"reads/reader/min":>18}{"empty":>8}{"delay mean s":>14}{"delay p95 s":>13}'
+          f'{"cache rtt/reader/min":>22}')
+    for name, interval, wait in (('poll every 60 s', 60, 0), ('poll every 1 s', 1, 0),
+                                 (f'long poll {args.wait:g} s', 0, args.wait)):
+        db = fakes.FakeMySQLServer(0)
+        cache_server = fakes.FakeRedisServer(0)
+        fakes.install(resources, db, cache_server)
+        cache.long_poll_seconds = wait * scale
+        assert user_handler.rebuild_blocks_lambda({}, None)['statusCode'] == 200
+        readers = [str(uuid.UUID(int=100 + i)) for i in range(args.readers)]
+        sent = {}  # message text -> (simulated) time of sending
+        delays = []
+        reads = []
+        start = time.monotonic()
+        end = start + args.minutes * 60 * scale
+
+        def now():
+            return (time.monotonic() - start) / scale
+
+        def read(reader_id):
+            # as the client does: since the last message read (and at first, since now)
+            min_timestamp = str(datetime.now())
+            while time.monotonic() < end:
+                response = read_handler.read_messages_lambda(common.make_event(
+                    user_id=reader_id, min_timestamp=min_timestamp, wait_seconds=wait * scale), None)
+                assert response['statusCode'] == 200, response
+                messages = json.loads(response['body'])
+                reads.append(len(messages))
+                for message in messages:
+                    delays.append(now() - sent[message['message_text']])
+                if messages:
+                    min_timestamp = str(codec.from_epoch_us(messages[0]['timestamp_us'] + 1))
+                if interval:
+                    time.sleep(interval * scale)
+
+        def send():
+            sender = str(uuid.UUID(int=1))
+            rng = random.Random(0)
+            while True:
+                time.sleep(rng.expovariate(len(readers) / args.gap) * scale)
+                if time.monotonic() >= end:
+                    return
+                text = f'message {len(sent)}'
+                sent[text] = now()
+                response = user_handler.send_lambda(common.make_event(
+                    sending_user_id=sender, receiving_user_id=rng.choice(readers), message_text=text), None)
+                assert response['statusCode'] == 200, response
+
+        threads = [threading.Thread(target=read, args=(reader_id,)) for reader_id in readers]
+        threads.append(threading.Thread(target=send))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        per_minute = len(reads) / len(readers) / args.minutes
+        delay = (f'{statistics.fmean(delays):>14.2f}{statistics.quantiles(delays, n=20)[18]:>13.2f}'
+                 if len(delays) > 1 else f'{"-":>14}{"-":>13}')
+        print(f'{name:<22}{per_minute:>18.1f}{sum(1 for count in reads if not count) / len(reads):>8.0%}{delay}'
+              f'{cache_server.round_trips.count / len(readers) / args.minutes:>22.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Insert throughput and table / index size of the messages table: random uuid4 strings vs time-ordered ids.
+
+Needs a real MySQL-compatible server (DB_HOST / DB_USER / DB_PASS). The tables are created in a scratch
+database which is dropped at the end.
+
+Run from the project root:  python bench/message_ids.py [--rows 200000] [--batch 1000]
+"""
+import argparse
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import common  # noqa: F401 (sets up the import path)
+import ids
+import resources
+import schema
+
+variants = [
+    # name, message_id column, new message id
+    ('uuid4 VARCHAR(255)', 'VARCHAR(255)', lambda: str(uuid.uuid4())),
+    ('uuid7 VARCHAR(255)', 'VARCHAR(255)', ids.new_id),
+    ('uuid7 BINARY(16)', 'BINARY(16)', lambda: ids.to_bytes(ids.new_id())),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--database', default='message_ids_bench')
+    args = parser.parse_args()
+
+    schema.db_name = args.database
+    connection = resources.get_db_connection()
+    users = [ids.new_id() for _ in range(1000)]
+    start = datetime(2024, 7, 1)
+    print(f'{"message_id":<22}{"rows/s":>10}{"data MB":>10}{"index MB":>10}')
+    try:
+        with connection.cursor() as cursor:
+            for i, (name, column, new_id) in enumerate(variants):
+                table = f'messages_{i}'
+                cursor.execute(f"""
+                CREATE TABLE {table} (
+                message_id {column} PRIMARY KEY,
+                sending_user_id VARCHAR(255),
+                receiving_user_id VARCHAR(255),
+                message_text VARCHAR(255),
+                timestamp TIMESTAMP(6) NOT NULL,
+                INDEX receiving_user_timestamp_idx (receiving_user_id, timestamp)
+                )
+                """)
+                elapsed = 0.0
+                for offset in range(0, args.rows, args.batch):
+                    rows = [(new_id(), users[n % 1000], users[(n * 7) % 1000], 'hi', start + timedelta(seconds=n))
+                            for n in range(offset, min(offset + args.batch, args.rows))]
+                    begin = time.perf_counter()
+                    cursor.executemany(f'INSERT INTO {table} (message_id, sending_user_id, receiving_user_id, '
+                                       f'message_text, timestamp) VALUES (%s, %s, %s, %s, %s)', rows)
+                    elapsed += time.perf_counter() - begin
+                cursor.execute(f'ANALYZE TABLE {table}')
+                cursor.execute('SELECT data_length, index_length FROM information_schema.TABLES '
+                               'WHERE table_schema=%s AND table_name=%s', (args.database, table))
+                data_length, index_length = cursor.fetchone()
+                print(f'{name:<22}{args.rows / elapsed:>10.0f}{data_length / 2 ** 20:>10.1f}'
+                      f'{index_length / 2 ** 20:>10.1f}')
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE {args.database}')
+        resources.close_all()
+
+
+if __name__ == '__main__':
+    main()
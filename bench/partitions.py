@@ -0,0 +1,129 @@
+"""The monthly partitions of the messages tables: the latency of the read_messages DB query as the history grows,
+and the maintenance of the partitions (lambda/retention.py).
+
+For each history length, a scratch database is migrated and partitioned from that many months ago, the
+maintenance catches up (creating the months since), the tables are filled with --rows-per-month messages per
+month and the query for the last hour is timed. Then the maintenance expires the months beyond --retention.
+
+Needs a real MySQL-compatible server (DB_HOST / DB_USER / DB_PASS). Exits with 1 if the query visits the
+partitions of older months, or the maintenance leaves expired or missing months.
+
+Run from the project root:  python bench/partitions.py [--months 1 6 24] [--rows-per-month 20000] [--retention 12]
+"""
+import argparse
+import sys
+import uuid
+from datetime import date, datetime, timedelta
+
+import common
+import ids
+import pymysql
+import read_handler
+import resources
+import retention
+import schema
+
+
+def seed(cursor, start, now, rows_per_month, months):
+    users = [str(uuid.uuid4()) for _ in range(100)]
+    groups = [str(uuid.uuid4()) for _ in range(20)]
+    cursor.executemany('INSERT INTO group_members_table (group_id, user_id) VALUES (%s, %s)',
+                       [(group, user) for i, group in enumerate(groups) for user in users[i::7]])
+    rows = rows_per_month * months
+    step = (now - start) / rows
+    for offset in range(0, rows, 10000):
+        batch = range(offset, min(offset + 10000, rows))
+        cursor.executemany(
+            'INSERT INTO user_messages_table (message_id, sending_user_id, receiving_user_id, message_text, '
+            'timestamp) VALUES (%s, %s, %s, %s, %s)',
+            [(ids.to_bytes(ids.new_id()), users[i % 100], users[(i * 7) % 100], 'hi', start + step * i)
+             for i in batch])
+        cursor.executemany(
+            'INSERT INTO group_messages_table (message_id, sending_user_id, group_id, message_text, timestamp) '
+            'VALUES (%s, %s, %s, %s, %s)',
+            [(ids.to_bytes(ids.new_id()), users[i % 100], groups[i % 20], 'hello', start + step * i)
+             for i in batch])
+    for table in ('group_members_table', 'user_messages_table', 'group_messages_table'):
+        cursor.execute(f'ANALYZE TABLE {table}')
+    return users[0], rows
+
+
+def run(args, months):
+    # returns the failures
+    failures = []
+    today = date.today()
+    now = datetime.now()
+    start = retention.month_start(today, -months + 1)
+
+    schema._schema_ready = False
+    connection = resources.get_db_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            # as if migration 7 ran that many months ago, and the maintenance stopped since
+            retention.partition_tables(cursor, start)
+            retention.retention_months = 0
+            created, _ = retention.maintain(connection, today)
+            expected = {f'{table}.{retention.partition_name(retention.month_start(start, i))}'
+                        for table in retention.tables for i in range(retention.months_ahead + 1, months +
+                                                                     retention.months_ahead)}
+            if not expected <= set(created):
+                failures.append(f'maintenance did not create {sorted(expected - set(created))}')
+
+            user_id, rows = seed(cursor, datetime.combine(start, datetime.min.time()), now, args.rows_per_month,
+                                 months)
+            params = {'user_id': user_id, 'min_timestamp': str(now - timedelta(hours=1))}
+            cursor.execute('EXPLAIN ' + read_handler.db_read_query, params)
+            partitions = {row['table']: row['partitions'] for row in cursor.fetchall() if row['partitions']}
+
+            def read():
+                cursor.execute(read_handler.db_read_query, params)
+                cursor.fetchall()
+
+            latency = common.summary(common.timed(read, args.repeat))
+            visited = {name for names in partitions.values() for name in names.split(',')}
+            print(f'{months:>7}{rows:>12}{len(visited):>20}{latency["p50_ms"]:>10.2f}{latency["p95_ms"]:>10.2f}')
+            # this month's and the (empty) ones after it only
+            this_month = retention.partition_name(retention.month_start(today))
+            older = sorted(name for name in visited
+                           if name == retention.history_partition or name != retention.future_partition
+                           and name < this_month)
+            if older:
+                failures.append(f'{months} months: the read visits the partitions of older months {older}')
+
+            retention.retention_months = args.retention
+            _, expired = retention.maintain(connection, today)
+            left = [name for table in retention.tables for name, bound in retention.read_partitions(cursor, table)
+                    if bound is not None and bound <= retention.month_start(today, -args.retention)]
+            if left:
+                failures.append(f'{months} months: expired partitions left {left}')
+            if months > args.retention + 1 and not expired:
+                failures.append(f'{months} months: nothing expired')
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE {args.database}')
+        resources.close_all()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--months', type=int, nargs='+', default=[1, 6, 24])
+    parser.add_argument('--rows-per-month', type=int, default=20000)
+    parser.add_argument('--retention', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--database', default='partitions_check')
+    args = parser.parse_args()
+
+    schema.db_name = args.database
+    print(f'{"months":>7}{"rows":>12}{"partitions visited":>20}{"p50 ms":>10}{"p95 ms":>10}')
+    failures = []
+    for months in args.months:
+        failures += run(args, months)
+
+    for failure in failures:
+        print(f'FAILED  {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
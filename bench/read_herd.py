@@ -0,0 +1,104 @@
+"""Concurrent read_messages of a user whose cached messages just expired: the DB queries with and without waiting.
+
+Each round evicts the reader's cached messages and starts --readers concurrent reads of them (threads, as
+invocations on separate containers). With single-flight, the first read takes the user's lock and queries the
+DB, the others wait for it to refill the cache. With no waiting (fill_wait_seconds 0) every read queries the DB.
+Each --rows is the number of messages read: more than the cache keeps (cache_length) are served to the waiting
+reads from the refill published by the first one.
+
+Run from the project root:  python bench/read_herd.py [--readers 50] [--rounds 20] [--query-ms 20] [--rows 5 50]
+Exits with 1 if single-flight lets more than one read per round query the DB.
+"""
+import argparse
+import itertools
+import json
+import statistics
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import common
+import fakes
+import cache
+import resources
+import read_handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--query-ms', type=float, default=20, help='time the DB takes to run the read query')
+    parser.add_argument('--db-rtt-ms', type=float, default=1)
+    parser.add_argument('--cache-rtt-ms', type=float, default=0.5)
+    parser.add_argument('--rows', type=int, nargs='+', default=[5, 50])
+    args = parser.parse_args()
+
+    reader = str(uuid.UUID(int=50))
+    sender = str(uuid.UUID(int=1))
+    start = datetime.now() - timedelta(minutes=10)
+    min_timestamp = str(start)
+
+    ok = True
+    print(f'{"rows":>5}  {"mode":<14}{"db queries/round":>18}{"max":>6}{"read p50 ms":>13}{"read p99 ms":>13}'
+          f'{"cache rtt/read":>16}')
+    modes = (('single-flight', cache.fill_wait_seconds), ('no waiting', 0))
+    for row_count, (name, wait_seconds) in itertools.product(args.rows, modes):
+        rows = [(start + timedelta(seconds=i), 0, sender, f'message {i}') for i in range(1, row_count + 1)]
+
+        def respond(query, query_args, rows=rows):
+            if 'UNION ALL' in query:
+                time.sleep(args.query_ms / 1000)
+                # the gap before the cached messages only
+                return [row for row in rows if 'max_timestamp' not in query_args
+                        or row[0] < query_args['max_timestamp']]
+            return ()
+
+        db = fakes.FakeMySQLServer(args.db_rtt_ms / 1000, responder=respond)
+        cache_server = fakes.FakeRedisServer(args.cache_rtt_ms / 1000)
+        fakes.install(resources, db, cache_server)
+        saved, cache.fill_wait_seconds = cache.fill_wait_seconds, wait_seconds
+        client = resources.get_cache_client()
+        queries = []
+        latencies = []
+        cache_before = cache_server.round_trips.count
+        try:
+            for _ in range(args.rounds):
+                client.delete(cache.user_messages_key(reader), cache.last_delivered_key(reader),
+                              cache.fill_result_key(reader))
+                queries_before = sum('UNION ALL' in query for query in db.queries)
+                barrier = threading.Barrier(args.readers)
+
+                def read():
+                    barrier.wait()
+                    began = time.perf_counter()
+                    response = read_handler.read_messages_lambda(common.make_event(
+                        user_id=reader, min_timestamp=min_timestamp), None)
+                    latencies.append((time.perf_counter() - began) * 1000)
+                    assert response['statusCode'] == 200, response
+                    assert len(json.loads(response['body'])) == row_count, response
+
+                threads = [threading.Thread(target=read) for _ in range(args.readers)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                queries.append(sum('UNION ALL' in query for query in db.queries) - queries_before)
+        finally:
+            cache.fill_wait_seconds = saved
+
+        percentiles = statistics.quantiles(latencies, n=100)
+        cache_rtt = (cache_server.round_trips.count - cache_before) / len(latencies)
+        print(f'{row_count:>5}  {name:<14}{statistics.fmean(queries):>18.1f}{max(queries):>6}'
+              f'{statistics.median(latencies):>13.2f}{percentiles[98]:>13.2f}{cache_rtt:>16.1f}')
+        if wait_seconds and max(queries) > 1:
+            print(f'FAILED  {name}, {row_count} rows: up to {max(queries)} DB queries in a round')
+            ok = False
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
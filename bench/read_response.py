@@ -0,0 +1,54 @@
+"""The read_messages response body: the former stringified list of tuples vs the JSON array of messages.
+
+Run from the project root:  python bench/read_response.py [--repeat 20]
+"""
+import argparse
+import json
+import tracemalloc
+import uuid
+
+import common
+import codec
+import response
+
+
+def former_body(cached, rows):
+    # what read_messages returned before: the repr of the records (timestamps as datetimes) in a JSON string
+    records = [(codec.from_epoch_us(timestamp_us), is_group, sending_user_id, message_text)
+               for timestamp_us, is_group, sending_user_id, message_text in cached] + list(rows)
+    return json.dumps(f'success in reading messages via cache and db: {str(records)}')
+
+
+def peak_kb(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'{"messages":>9}{"former ms":>11}{"former KB":>11}{"json ms":>9}{"json KB":>9}{"body KB":>9}')
+    for count in (20, 10000):
+        # half from the cache, half from the db (older)
+        start = 1719824400000000
+        cached = [(start + count - i, i % 2, str(uuid.UUID(int=i % 100)), f'hello {i}') for i in range(count // 2)]
+        rows = [(codec.from_epoch_us(start + count // 2 - i), i % 2, str(uuid.UUID(int=i % 100)), f'hi {i}')
+                for i in range(count - count // 2)]
+
+        body = response.messages_body(cached, rows)
+        assert len(json.loads(body)) == count
+
+        results = []
+        for fn in (lambda: former_body(cached, rows), lambda: response.messages_body(cached, rows)):
+            results.append((common.summary(common.timed(fn, args.repeat))['mean_ms'], peak_kb(fn)))
+        (former_ms, former_kb), (json_ms, json_kb) = results
+        print(f'{count:>9}{former_ms:>11.3f}{former_kb:>11.0f}{json_ms:>9.3f}{json_kb:>9.0f}{len(body) / 1024:>9.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Cache memory and read CPU of the binary record codec vs the former '{timestamp}:: ...' strings.
+
+Run from the project root:  python bench/record_codec.py [--repeat 200]
+"""
+import argparse
+import uuid
+from datetime import datetime, timedelta
+
+import common
+import codec
+
+
+def legacy_records(count):
+    start = datetime(2024, 7, 1, 9)
+    return [f'{start + timedelta(seconds=i, microseconds=i + 1)}:: {i % 2} {uuid.uuid4()}:: message number {i}'.encode()
+            for i in range(count)]
+
+
+def legacy_read(records, min_timestamp):
+    # what read_messages did with each cached string before the codec
+    min_timestamp = datetime.strptime(min_timestamp, '%Y-%m-%d %H:%M:%S.%f')
+    messages = []
+    for record in records:
+        timestamp = datetime.strptime(record.decode('utf-8').split('::')[0], '%Y-%m-%d %H:%M:%S.%f')
+        if timestamp >= min_timestamp:
+            messages.append(record)
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{"records":>8}{"string B":>10}{"binary B":>10}{"memory":>9}{"string ms":>11}{"binary ms":>11}{"cpu":>8}')
+    for count in (20, 1000):
+        strings = legacy_records(count)
+        binary = [codec.encode(*message) for message in codec.decode_many(strings)]
+        assert codec.decode_many(binary) == codec.decode_many(strings)
+
+        string_bytes = sum(map(len, strings)) / count
+        binary_bytes = sum(map(len, binary)) / count
+        string_ms = common.summary(common.timed(lambda: legacy_read(strings, '2024-07-01 09:00:00.0'), args.repeat))
+        binary_ms = common.summary(common.timed(lambda: codec.decode_many(binary), args.repeat))
+
+        print(f'{count:>8}{string_bytes:>10.0f}{binary_bytes:>10.0f}{binary_bytes / string_bytes - 1:>+9.0%}'
+              f'{string_ms["mean_ms"]:>11.3f}{binary_ms["mean_ms"]:>11.3f}'
+              f'{binary_ms["mean_ms"] / string_ms["mean_ms"] - 1:>+8.0%}')
+
+
+if __name__ == '__main__':
+    main()
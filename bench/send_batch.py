@@ -0,0 +1,72 @@
+"""Sending a burst of messages: one send invocation per message vs a single send_batch.
+
+Run from the project root:  python bench/send_batch.py [--repeat 5] [--db-rtt-ms 1] [--cache-rtt-ms 0.5]
+"""
+import argparse
+import json
+import uuid
+
+import common
+import fakes
+import resources
+import user_handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db-rtt-ms', type=float, default=1.0)
+    parser.add_argument('--cache-rtt-ms', type=float, default=0.5)
+    args = parser.parse_args()
+
+    db = fakes.FakeMySQLServer(args.db_rtt_ms / 1000)
+    cache = fakes.FakeRedisServer(args.cache_rtt_ms / 1000)
+    fakes.install(resources, db, cache)
+    # the block list is loaded (as after a deploy)
+    assert user_handler.rebuild_blocks_lambda({}, None)['statusCode'] == 200
+
+    sender = str(uuid.UUID(int=0))
+    print(f'{"batch":>6}{"send ms/msg":>13}{"rtt/msg":>9}{"batch ms/msg":>14}{"rtt/msg":>9}{"batch msgs/s":>14}')
+    for batch_size in (1, 10, 100, 1000):
+        messages = [{'sending_user_id': sender, 'receiving_user_id': str(uuid.UUID(int=1 + i % 50)),
+                     'message_text': f'notification {i}'} for i in range(batch_size)]
+        events = [common.make_event(**message) for message in messages]
+        batch_event = {'body': json.dumps(messages)}
+
+        def send_each():
+            for event in events:
+                assert user_handler.send_lambda(event, None)['statusCode'] == 200
+
+        def send_batch():
+            assert user_handler.send_batch_lambda(batch_event, None)['statusCode'] == 200
+
+        results = []
+        for fn in (send_each, send_batch):
+            fn()  # warm
+            round_trips = db.round_trips.count + cache.round_trips.count
+            ms = common.summary(common.timed(fn, args.repeat))['mean_ms'] / batch_size
+            rtt = (db.round_trips.count + cache.round_trips.count - round_trips) / args.repeat / batch_size
+            results.append((ms, rtt))
+
+        (each_ms, each_rtt), (batch_ms, batch_rtt) = results
+        print(f'{batch_size:>6}{each_ms:>13.3f}{each_rtt:>9.2f}{batch_ms:>14.3f}{batch_rtt:>9.3f}'
+              f'{1000 / batch_ms:>14.0f}')
+
+    # the receivers' first messages: each counter is seeded from the DB first (the ones above are warm)
+    batch_size = 1000
+    receivers = (str(uuid.UUID(int=1000 + i)) for i in range(batch_size * (args.repeat + 1)))
+
+    def send_batch_cold():
+        messages = [{'sending_user_id': sender, 'receiving_user_id': next(receivers), 'message_text': 'welcome'}
+                    for _ in range(batch_size)]
+        assert user_handler.send_batch_lambda({'body': json.dumps(messages)}, None)['statusCode'] == 200
+
+    send_batch_cold()  # warm
+    round_trips = db.round_trips.count + cache.round_trips.count
+    ms = common.summary(common.timed(send_batch_cold, args.repeat))['mean_ms'] / batch_size
+    rtt = (db.round_trips.count + cache.round_trips.count - round_trips) / args.repeat / batch_size
+    print(f'\n{batch_size} new receivers in a batch: {ms:.3f} ms/msg, {rtt:.3f} rtt/msg')
+
+
+if __name__ == '__main__':
+    main()
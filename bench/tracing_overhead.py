@@ -0,0 +1,120 @@
+"""The cost of the per-phase tracing (TRACING=1) on send, send_group and read_messages, and a sample log line.
+
+The stand-ins answer with no simulated round trip time by default, so the difference is the CPU time of the
+tracing itself. The round trips in the log lines are checked against the ones the stand-ins counted.
+
+Run from the project root:  python bench/tracing_overhead.py [--repeat 2000] [--db-rtt-ms 0] [--cache-rtt-ms 0]
+Exits with 1 if the logged round trips are wrong.
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import sys
+import uuid
+
+import common
+import fakes
+import resources
+import tracing
+
+
+class CountedRoundTrips(fakes.RoundTrips):
+    # the stand-ins bypass the counting driver classes of tracing, so they report their round trips themselves
+    def __init__(self, rtt_seconds, count):
+        super().__init__(rtt_seconds)
+        self._count = count
+
+    def wait(self, n=1):
+        self._count(n)
+        super().wait(n)
+
+
+def load(enabled, args):
+    # tracing is decided when the handlers are imported, as on a lambda container
+    os.environ['TRACING'] = '1' if enabled else '0'
+    importlib.reload(tracing)
+    importlib.reload(resources)
+    handlers = [importlib.reload(importlib.import_module(name))
+                for name in ('user_handler', 'group_handler', 'read_handler')]
+
+    db = fakes.FakeMySQLServer(0, responder=members_responder)
+    db.round_trips = CountedRoundTrips(args.db_rtt_ms / 1000, lambda n: tracing.count_db(n))
+    cache_server = fakes.FakeRedisServer(0)
+    cache_server.round_trips = CountedRoundTrips(args.cache_rtt_ms / 1000, lambda n: tracing.count_cache(n))
+    fakes.install(resources, db, cache_server)
+    return handlers, db, cache_server
+
+
+def members_responder(query, args):
+    if query.lstrip().startswith('SELECT user_id'):
+        return [(str(uuid.UUID(int=i)),) for i in range(10)]
+    return ()
+
+
+def scenarios(user_handler, group_handler, read_handler):
+    user, other, group, reader = (str(uuid.UUID(int=i)) for i in (0, 1, 2, 50))
+    return [
+        ('send', user_handler.send_lambda,
+         common.make_event(sending_user_id=other, receiving_user_id=user, message_text='hi')),
+        ('send_group', group_handler.send_group_lambda,
+         common.make_event(sending_user_id=other, group_id=group, message_text='hello_group')),
+        ('read_messages', read_handler.read_messages_lambda,
+         common.make_event(user_id=reader, min_timestamp='2024-07-01 09:00:00.0')),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--db-rtt-ms', type=float, default=0.0)
+    parser.add_argument('--cache-rtt-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    latencies = {}
+    samples = {}
+    ok = True
+    for enabled in (False, True):
+        handlers, db, cache_server = load(enabled, args)
+        user_handler = handlers[0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert user_handler.rebuild_blocks_lambda({}, None)['statusCode'] == 200
+        for name, handler, event in scenarios(*handlers):
+            def invoke():
+                assert handler(event, None)['statusCode'] == 200
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                invoke()  # warm
+            with contextlib.redirect_stdout(io.StringIO()) as log:
+                db_before, cache_before = db.round_trips.count, cache_server.round_trips.count
+                invoke()
+                db_rtt, cache_rtt = db.round_trips.count - db_before, cache_server.round_trips.count - cache_before
+            lines = log.getvalue().splitlines()
+            with contextlib.redirect_stdout(io.StringIO()):
+                latencies[name, enabled] = common.summary(common.timed(invoke, args.repeat))
+
+            if enabled:
+                record = json.loads(lines[-1])
+                samples[name] = lines[-1]
+                if (record['db_round_trips'], record['cache_round_trips']) != (db_rtt, cache_rtt):
+                    print(f'FAILED  {name}: logged {record["db_round_trips"]} db / {record["cache_round_trips"]} '
+                          f'cache round trips, made {db_rtt} / {cache_rtt}')
+                    ok = False
+            elif lines:
+                print(f'FAILED  {name}: logged with tracing disabled')
+                ok = False
+
+    print(f'{"handler":<16}{"off p50 ms":>12}{"on p50 ms":>12}{"overhead us":>13}')
+    for name, _, _ in scenarios(*handlers):
+        off, on = latencies[name, False]['p50_ms'], latencies[name, True]['p50_ms']
+        print(f'{name:<16}{off:>12.3f}{on:>12.3f}{(on - off) * 1000:>13.1f}')
+    for name, line in samples.items():
+        print(f'\n{name}:\n{line}')
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Write-behind mode: the delivery guarantees (checked against the stand-ins) and the latency of send.
+
+Run from the project root:  python bench/write_behind.py [--repeat 200] [--db-rtt-ms 1] [--cache-rtt-ms 0.5]
+Exits with 1 if a guarantee does not hold.
+"""
+import argparse
+import sys
+import uuid
+from datetime import datetime
+
+import common
+import fakes
+import pymysql
+import cache
+import codec
+import ids
+import outbox
+import resources
+import sequence
+import drain_handler
+import group_handler
+import read_handler
+import user_handler
+
+
+class Tables:
+    # just enough of the messages tables for the queries of send, send_group, read_messages and the drainer
+    def __init__(self):
+        self.user_messages = {}
+        self.group_messages = {}
+        self.group_members = set()
+
+    def respond(self, query, args):
+        if 'ON DUPLICATE KEY' in query and len(args[3]) > 255:
+            raise pymysql.DataError(1406, "Data too long for column 'message_text' at row 1")
+        elif 'ON DUPLICATE KEY' in query and 'INTO user_messages_table' in query:
+            self.user_messages.setdefault(args[0], args)
+        elif 'ON DUPLICATE KEY' in query and 'INTO group_messages_table' in query:
+            self.group_messages.setdefault(args[0], args)
+        elif 'INSERT INTO user_messages_table' in query or 'INSERT INTO group_messages_table' in query:
+            raise AssertionError('write-behind send inserted into the db')
+        elif 'UNION ALL' in query:
+            return self.read(args)
+        elif query.startswith('SELECT user_id FROM group_members_table'):
+            return [(user_id,) for group_id, user_id in self.group_members if group_id in query]
+        elif query.startswith('SELECT group_id FROM group_members_table'):
+            return [(group_id,) for group_id, user_id in self.group_members if user_id == args[0]]
+        return ()
+
+    def read(self, args):
+        def selected(timestamp):
+            return str(timestamp) >= args['min_timestamp'] and ('max_timestamp' not in args
+                                                                or timestamp < args['max_timestamp'])
+
+        groups = {group_id for group_id, user_id in self.group_members if user_id == args['user_id']}
+        rows = [(timestamp, 0, sender, text)
+                for _, sender, receiver, text, timestamp, *_ in self.user_messages.values()
+                if receiver == args['user_id'] and selected(timestamp)]
+        rows += [(timestamp, 1, sender, text) for _, sender, group_id, text, timestamp in self.group_messages.values()
+                 if group_id in groups and selected(timestamp)]
+        return rows
+
+
+def read(user_id, **params):
+    # read_messages after the user's cached messages were evicted, so it has to fall back to the db
+    cache_client = resources.get_cache_client()
+    cache_client.delete(cache.user_messages_key(user_id), cache.last_delivered_key(user_id),
+                        sequence.sequenced_key(user_id))
+    response = read_handler.read_messages_lambda(
+        common.make_event(user_id=user_id, min_timestamp='2000-01-01 00:00:00.0', **params), None)
+    assert response['statusCode'] == 200, response
+    return response['body']
+
+
+def drain(expected_status=200):
+    response = drain_handler.drain_lambda({'seconds': 0}, None)
+    assert response['statusCode'] == expected_status, response
+
+
+def check_guarantees(server, tables):
+    sender, receiver, member = (str(uuid.UUID(int=i)) for i in range(1, 4))
+    group = str(uuid.UUID(int=100))
+    tables.group_members.update({(group, sender), (group, member)})
+    checks = []
+
+    def check(name, ok):
+        checks.append(ok)
+        print(f'{"ok" if ok else "FAILED":<8}{name}')
+
+    def send(text):
+        return user_handler.send_lambda(
+            common.make_event(sending_user_id=sender, receiving_user_id=receiver, message_text=text), None)
+
+    assert send('first')['statusCode'] == 200
+    check('a sent message is not in the db, but in the stream', not tables.user_messages
+          and server.cmd_xlen(outbox.stream_key) == 1)
+    check('a read falling back to the db sees the undrained message', 'first' in read(receiver))
+    check('... also by its seq', 'first' in read(receiver, after_seq=0))
+    response = read_handler.read_messages_lambda(common.make_event(user_id=receiver, after_seq=0), None)
+    check('... also by its seq alone (no min_timestamp)', response['statusCode'] == 200
+          and 'first' in response['body'])
+
+    response = group_handler.send_group_lambda(
+        common.make_event(sending_user_id=sender, group_id=group, message_text='to the group'), None)
+    assert response['statusCode'] == 200, response
+    check('... and the undrained group message', 'to the group' in read(member))
+
+    drain()
+    check('the drainer inserts the messages and empties the stream and the pending sets',
+          len(tables.user_messages) == 1 and len(tables.group_messages) == 1
+          and server.cmd_xlen(outbox.stream_key) == 0
+          and not any(key.startswith(b'pending') for key in server.data))
+    check('a read after the drain sees the message once', read(receiver).count('first') == 1)
+
+    # the drainer fails after inserting, before acknowledging
+    assert send('second')['statusCode'] == 200
+    cmd_xack = server.cmd_xack
+    server.cmd_xack = lambda *args: 1 / 0
+    drain(expected_status=500)
+    server.cmd_xack = cmd_xack
+    check('a message both inserted and pending is read once', read(receiver).count('second') == 1)
+    drain()
+    check('an unacknowledged message is drained again - and inserted once (at least once + idempotent insert)',
+          len(tables.user_messages) == 2 and server.cmd_xlen(outbox.stream_key) == 0)
+
+    # redis fails during the send: nothing is stored, and the client gets an error (to retry)
+    cmd_xadd = server.cmd_xadd
+    server.cmd_xadd = lambda *args: 1 / 0
+    response = send('third')
+    server.cmd_xadd = cmd_xadd
+    drain()
+    check('a send failing in redis returns an error and stores nothing',
+          response['statusCode'] == 500 and len(tables.user_messages) == 2 and 'third' not in read(receiver))
+
+    # a message the DB can't store
+    response = send('x' * 256)
+    check('a send the DB would reject returns 400 and queues nothing',
+          response['statusCode'] == 400 and server.cmd_xlen(outbox.stream_key) == 0)
+    # ... queued anyway (e.g. by a former version): it does not hold up the messages after it
+    with resources.get_cache_client().pipeline(transaction=True) as pipe:
+        outbox.queue(pipe, ids.new_id(), 0, sender, receiver, 'y' * 256, codec.epoch_us(datetime.now()))
+        pipe.execute()
+    assert send('fourth')['statusCode'] == 200
+    drain()
+    check('a message the DB rejects does not fail the drain of the others',
+          len(tables.user_messages) == 3 and server.cmd_xlen(outbox.stream_key) == 1)
+    for _ in range(outbox.max_deliveries - 1):
+        drain()
+    check('... it is retried, then moved to the dead letters', server.cmd_xlen(outbox.stream_key) == 0
+          and server.cmd_xlen(outbox.dead_letters_key) == 1
+          and not any(key.startswith(b'pending') for key in server.data))
+
+    return all(checks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--db-rtt-ms', type=float, default=1.0)
+    parser.add_argument('--cache-rtt-ms', type=float, default=0.5)
+    args = parser.parse_args()
+
+    tables = Tables()
+    db = fakes.FakeMySQLServer(0, responder=tables.respond)
+    cache_server = fakes.FakeRedisServer(0)
+    fakes.install(resources, db, cache_server)
+    outbox.write_behind = True
+    ok = check_guarantees(cache_server, tables)
+
+    print()
+    db = fakes.FakeMySQLServer(args.db_rtt_ms / 1000)
+    cache_server = fakes.FakeRedisServer(args.cache_rtt_ms / 1000)
+    fakes.install(resources, db, cache_server)
+    assert user_handler.rebuild_blocks_lambda({}, None)['statusCode'] == 200
+    event = common.make_event(sending_user_id=str(uuid.UUID(int=1)), receiving_user_id=str(uuid.UUID(int=2)),
+                              message_text='hi')
+
+    def send():
+        assert user_handler.send_lambda(event, None)['statusCode'] == 200
+
+    print(f'{"send":<15}{"mean ms":>10}{"p50 ms":>10}{"db rtt":>8}{"cache rtt":>11}')
+    for name, write_behind in (('write-through', False), ('write-behind', True)):
+        outbox.write_behind = write_behind
+        send()
+        db_rtt, cache_rtt = db.round_trips.count, cache_server.round_trips.count
+        latency = common.summary(common.timed(send, args.repeat))
+        print(f'{name:<15}{latency["mean_ms"]:>10.2f}{latency["p50_ms"]:>10.2f}'
+              f'{(db.round_trips.count - db_rtt) / args.repeat:>8.1f}'
+              f'{(cache_server.round_trips.count - cache_rtt) / args.repeat:>11.1f}')
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
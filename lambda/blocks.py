@@ -0,0 +1,118 @@
+import os
+
+# the block list in the cache, so sending doesn't query the DB (which stays the source of truth).
+# the sets are complete only while blocks_ready_key exists - it is set by rebuild()
+blocks_ready_key = 'blocks_ready'
+# ... or, for a single user, once the set of the user was loaded from the DB (load_block_lists) - it has this member
+blocked_users_sentinel = b''
+
+# optional Bloom filter of all the 'blocking,blocked' pairs (needs the RedisBloom module)
+use_bloom_filter = os.environ.get('BLOCKS_BLOOM_FILTER', '0') == '1'
+bloom_key = 'blocks_bloom'
+bloom_error_rate = 0.001
+bloom_capacity = 100000
+
+blocks_table = 'blocks_table'
+
+
+def blocked_users_key(blocking_user_id):
+    # the users blocked by blocking_user_id
+    return f'blocked:{blocking_user_id}'
+
+
+def _pair(blocking_user_id, blocked_user_id):
+    return f'{blocking_user_id},{blocked_user_id}'
+
+
+def is_blocked(client, blocking_user_id, blocked_user_id):
+    # True / False, or None if the block list is not cached (then the DB has to be checked)
+    blocked = blocked_pairs(client, [(blocking_user_id, blocked_user_id)])
+    return None if blocked is None else bool(blocked)
+
+
+def blocked_pairs(client, pairs):
+    # the (blocking, blocked) pairs among pairs which are blocked, or None if the block lists are not cached
+    pairs = list(set(pairs))
+    if use_bloom_filter:
+        with client.pipeline(transaction=False) as pipe:
+            pipe.exists(blocks_ready_key)
+            pipe.bf().mexists(bloom_key, *(_pair(*pair) for pair in pairs))
+            ready, maybe_blocked = pipe.execute()
+        if ready:
+            # a fast (and almost always) negative answer. false positives (and unblocked pairs, which can't be
+            # removed from the filter) are settled by the sets
+            pairs = [pair for pair, maybe in zip(pairs, maybe_blocked) if maybe]
+            if not pairs:
+                return set()
+
+    with client.pipeline(transaction=False) as pipe:
+        pipe.exists(blocks_ready_key)
+        for blocking_user_id, blocked_user_id in pairs:
+            pipe.smismember(blocked_users_key(blocking_user_id), [blocked_users_sentinel, blocked_user_id])
+        ready, *results = pipe.execute()
+
+    if not ready and not all(loaded for loaded, _ in results):
+        return None
+    return {pair for pair, (_, blocked) in zip(pairs, results) if blocked}
+
+
+def load_block_lists(connection, client, blocking_user_ids):
+    # read the whole block lists of the users from the DB, and cache them. returns user id -> set of blocked ids
+    blocking_user_ids = list(set(blocking_user_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT blocking_user_id, blocked_user_id FROM {blocks_table} WHERE blocking_user_id IN %s',
+                       (blocking_user_ids,))
+        block_lists = {blocking_user_id: set() for blocking_user_id in blocking_user_ids}
+        for blocking_user_id, blocked_user_id in cursor.fetchall():
+            block_lists[blocking_user_id].add(blocked_user_id)
+
+    # added, not replaced, so a concurrent block is kept
+    with client.pipeline(transaction=False) as pipe:
+        for blocking_user_id, blocked_user_ids in block_lists.items():
+            pipe.sadd(blocked_users_key(blocking_user_id), blocked_users_sentinel, *blocked_user_ids)
+        pipe.execute()
+
+    return block_lists
+
+
+def add_block(client, blocking_user_id, blocked_user_id):
+    with client.pipeline(transaction=True) as pipe:
+        pipe.sadd(blocked_users_key(blocking_user_id), blocked_user_id)
+        if use_bloom_filter:
+            pipe.bf().add(bloom_key, _pair(blocking_user_id, blocked_user_id))
+        pipe.execute()
+
+
+def remove_block(client, blocking_user_id, blocked_user_id):
+    client.srem(blocked_users_key(blocking_user_id), blocked_user_id)
+
+
+def rebuild(connection, client):
+    """Reload the whole block list from the DB into the cache, returns the number of blocks.
+
+    Needed when the cache is cold (first deployment, or lost data). Blocks changed while it runs may
+    be missed - run it again if there were any.
+    """
+    # until done, sending checks the DB
+    client.delete(blocks_ready_key)
+    stale_keys = list(client.scan_iter(match=blocked_users_key('*'), count=1000))
+    if use_bloom_filter:
+        stale_keys.append(bloom_key)
+    if stale_keys:
+        client.delete(*stale_keys)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT blocking_user_id, blocked_user_id FROM {blocks_table}')
+        pairs = cursor.fetchall()
+
+    with client.pipeline(transaction=False) as pipe:
+        if use_bloom_filter:
+            pipe.bf().reserve(bloom_key, bloom_error_rate, max(bloom_capacity, len(pairs)))
+        for blocking_user_id, blocked_user_id in pairs:
+            pipe.sadd(blocked_users_key(blocking_user_id), blocked_user_id)
+        if use_bloom_filter and pairs:
+            pipe.bf().madd(bloom_key, *(_pair(*pair) for pair in pairs))
+        pipe.set(blocks_ready_key, 1)
+        pipe.execute()
+
+    return len(pairs)
@@ -0,0 +1,471 @@
+import heapq
+import os
+import time
+import codec
+import redis.exceptions
+import redis.lock
+
+cache_length = 20  # the last k messages kept per user
+ttl_seconds = 86400  # Key will expire in a day
+
+# groups with more members than this keep a single message log (fan-out on read) instead of
+# pushing every message to the cache of each member (fan-out on write)
+large_group_size = int(os.environ.get('LARGE_GROUP_SIZE', 100))
+group_log_length = 100  # the last messages kept per large group
+# large group id -> the score of the group's newest message. never expires, so a large group whose log expired
+# (or was evicted) is told apart from a small group, whose messages are in the members' own sets
+large_groups_key = 'large_groups'
+
+# per user, the score of the newest message delivered to the user's own set (the score of the single member of a
+# sorted set, so it only ever moves forward - ZADD GT). reads since a later time are empty without looking any
+# further (most polls of idle users) - or, for members of large groups, without reading the logs of the groups
+# which had no message since then either (see large_groups_key). it expires like the messages: without it, a
+# read just looks at the messages
+last_delivered_member = b''
+
+# in the set of the members of a group, marks that the set is complete (loaded from the DB). a set
+# without it (e.g. created by a join while the set was expired) is not used, but loaded again
+group_members_sentinel = b''
+
+# the keys in the format before the sorted sets (a list under the plain user id) are read until this time (epoch
+# seconds, LEGACY_LISTS_UNTIL - set at deploy time: the first deploy of the sorted sets plus ttl_seconds, 0 - never
+# read). until then none of a user's messages cached since that deploy has expired, so a list with no sorted set
+# next to it still holds all of the user's messages. the lists themselves never expire (the sends before the
+# sorted sets set no ttl): past the cutoff they are not looked up, and are left to be deleted (see the README)
+legacy_lists_until = int(os.environ.get('LEGACY_LISTS_UNTIL', '0'))
+
+# long polling: a read with nothing new waits up to this long (seconds) for a delivery to the reader, which
+# rings the reader's doorbell - or, for a large group, the group's doorbell, which all its waiting members read.
+# a doorbell is a stream of at most one ring, read (XREAD) after the time of the read which found nothing, so
+# it never misses a ring in between. 0 disables both
+long_poll_seconds = float(os.environ.get('LONG_POLL_SECONDS', 0))
+doorbell_ttl_seconds = 60  # a ring nobody waited for is dropped after a while
+max_stream_sequence = 2 ** 64 - 1  # the last stream id of a millisecond is {milliseconds}-{max_stream_sequence}
+
+# unread counters: per user, the messages delivered since the user's last read, by conversation (the field
+# 'user:{sender id}' or 'group:{group id}'). the messages of large groups are counted once per group instead -
+# the number sent to the group, minus the number when the member last read (or sent)
+unread_ttl_seconds = 30 * 86400
+group_sent_key = 'group_sent'  # large group id -> messages sent to the group
+# counts a message to a large group and sets the sender's seen count to the new number sent (the sender has seen
+# all of them, including the ones sent before the sender's first read)
+count_group_message_script = """
+local sent = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('HSET', KEYS[2], ARGV[1], sent)
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return sent
+"""
+
+# single-flight of the DB fallbacks of read_messages: one invocation at a time reads a user's messages from the
+# DB and refills the cache, the others wait for it to release its lock (polling) and read them from the cache
+fill_lock_seconds = 5  # the lock expires, in case its holder dies
+fill_wait_seconds = 2  # the longest a read waits for refills - then it reads the DB anyway
+fill_poll_seconds = 0.02
+# a refill with more messages than the cache keeps publishes all of them (up to fill_result_length) for a while,
+# so the reads waiting for it - and the ones right after - are served without the DB (see write_back)
+fill_result_seconds = 10
+fill_result_length = 1000
+
+
+def user_messages_key(user_id):
+    return f'messages:{user_id}'
+
+
+def group_log_key(group_id):
+    return f'group_messages:{group_id}'
+
+
+def user_groups_key(user_id):
+    return f'user_groups:{user_id}'
+
+
+def group_members_key(group_id):
+    return f'group_members:{group_id}'
+
+
+def last_delivered_key(user_id):
+    return f'last_delivered:{user_id}'
+
+
+def doorbell_key(user_id):
+    # a stream (the lists of before were doorbell:{user id})
+    return f'ring:{user_id}'
+
+
+def group_doorbell_key(group_id):
+    return f'group_ring:{group_id}'
+
+
+def unread_key(user_id):
+    return f'unread:{user_id}'
+
+
+def group_seen_key(user_id):
+    # large group id -> the messages sent to the group when the user last read (or sent to it)
+    return f'group_seen:{user_id}'
+
+
+def fill_lock_key(user_id):
+    return f'fill:{user_id}'
+
+
+def fill_result_key(user_id):
+    return f'filled:{user_id}'
+
+
+def append_messages(client, receiving_user_ids, value, score, extra=None):
+    # add the new message to every receiver
+    append_many(client, [(receiving_user_id, value, score) for receiving_user_id in receiving_user_ids], extra)
+
+
+def append_many(client, deliveries, extra=None):
+    # add each (receiving_user_id, value, score) message to its receiver, keeping only the newest cache_length
+    # messages, all in a single round trip (MULTI/EXEC, so no reader sees a set that is not trimmed yet).
+    # extra(pipe) may queue more commands in the same transaction (see outbox.queue)
+    newest = {}
+    with client.pipeline(transaction=True) as pipe:
+        if extra is not None:
+            extra(pipe)
+        for receiving_user_id, value, score in deliveries:
+            pipe.zadd(user_messages_key(receiving_user_id), {value: score})
+            newest[receiving_user_id] = max(score, newest.get(receiving_user_id, score))
+        for receiving_user_id in newest:
+            key = user_messages_key(receiving_user_id)
+            pipe.zremrangebyrank(key, 0, -cache_length - 1)
+            pipe.expire(key, ttl_seconds)
+        if newest:
+            _mark_delivered(pipe, newest)
+            _ring(pipe, [doorbell_key(receiving_user_id) for receiving_user_id in newest])
+        pipe.execute()
+
+
+def append_group_log(client, group_id, member_ids, value, score, extra=None):
+    # add the new message once, to the log of the (large) group
+    key = group_log_key(group_id)
+    with client.pipeline(transaction=True) as pipe:
+        if extra is not None:
+            extra(pipe)
+        pipe.zadd(key, {value: score})
+        pipe.zremrangebyrank(key, 0, -group_log_length - 1)
+        pipe.expire(key, ttl_seconds)
+        pipe.zadd(large_groups_key, {group_id: score}, gt=True)
+        # one ring for all the members (the waiting ones read the group's doorbell too)
+        _ring(pipe, [group_doorbell_key(group_id)])
+        pipe.zcard(key)
+        log_length = pipe.execute()[-1]
+
+    if log_length == 1:
+        # a new log (the group just grew large, or its log expired) - make sure every member reads it.
+        # later joins and leaves are kept up to date by update_group
+        with client.pipeline(transaction=False) as pipe:
+            for member_id in member_ids:
+                pipe.sadd(user_groups_key(member_id), group_id)
+            pipe.execute()
+
+
+def _ring(pipe, keys):
+    # wake the reads waiting on these doorbells (see wait_for_delivery)
+    if not long_poll_seconds:
+        return
+    for key in keys:
+        pipe.xadd(key, {'ring': 1}, maxlen=1, approximate=False)
+        pipe.expire(key, doorbell_ttl_seconds)
+
+
+def _doorbells(now, user_id, group_ids=()):
+    # the doorbells of the user and of the user's large groups -> the stream id after which a ring is new: the
+    # rings from now on (redis TIME). one earlier in the same millisecond wakes the read once more for nothing
+    seconds, microseconds = now
+    since = f'{seconds * 1000 + microseconds // 1000 - 1}-{max_stream_sequence}'
+    doorbells = {doorbell_key(user_id): since}
+    doorbells.update((group_doorbell_key(group_id), since) for group_id in group_ids)
+    return doorbells
+
+
+def doorbells(client, user_id):
+    # the user's doorbell from now on (see wait_for_delivery), for a read which does not go through read_messages
+    return _doorbells(client.time(), user_id)
+
+
+def fill_lock(client, user_id):
+    # the lock of refilling the user's messages from the DB
+    return redis.lock.Lock(client, fill_lock_key(user_id), timeout=fill_lock_seconds)
+
+
+def wait_for_fill(lock, timeout):
+    # wait up to timeout seconds for the invocation refilling the cache to release the lock, returns whether it did
+    deadline = time.monotonic() + timeout
+    while lock.locked():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(fill_poll_seconds)
+    return True
+
+
+def release_fill_lock(lock):
+    # a lock which expired meanwhile (and may be another invocation's by now) is left alone, and one which can't
+    # be released (redis is down) will expire
+    try:
+        lock.release()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def wait_for_delivery(client, doorbells, timeout):
+    """Wait up to timeout seconds for a ring of one of the doorbells, returns whether one rang meanwhile.
+
+    doorbells are as returned by read_messages (or doorbells): the rings since the read which found nothing new.
+    A ring of the user's own group message wakes it too (the caller reads again and waits for the rest of the
+    time if there is still nothing new).
+    """
+    return bool(client.xread(doorbells, count=1, block=max(1, int(timeout * 1000))))
+
+
+def count_unread(pipe, receiving_user_ids, conversation):
+    # queue counting a message to each receiver as unread on pipe (within the transaction which caches it).
+    # conversation: 'user:{sender id}' or 'group:{group id}'
+    for receiving_user_id in receiving_user_ids:
+        key = unread_key(receiving_user_id)
+        pipe.hincrby(key, conversation, 1)
+        pipe.expire(key, unread_ttl_seconds)
+
+
+def mark_users_read(client, user_id, sending_user_ids):
+    # the user's messages from these senders are read now (read by their numbers, without read_messages, which
+    # resets all the counters). the counters of the other conversations are kept
+    if sending_user_ids:
+        client.hdel(unread_key(user_id), *(f'user:{sending_user_id}' for sending_user_id in sending_user_ids))
+
+
+def count_group_unread(pipe, group_id, sending_user_id):
+    # the same for a message to a large group, once for all the members (the sender has seen it)
+    pipe.eval(count_group_message_script, 2, group_sent_key, group_seen_key(sending_user_id), group_id,
+              unread_ttl_seconds)
+
+
+def read_unread(client, user_id):
+    """The user's unread messages by conversation: ({sender id: count}, {group id: count}), without zeros.
+
+    A single round trip, or two for a member of large groups. The large groups count since the member's first
+    read (or message) - a member who never read one counts none.
+    """
+    with client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(unread_key(user_id))
+        pipe.smembers(user_groups_key(user_id))
+        pipe.hgetall(group_seen_key(user_id))
+        unread, group_ids, seen = pipe.execute()
+
+    users = {}
+    groups = {}
+    for conversation, count in unread.items():
+        kind, conversation_id = conversation.decode('utf-8').split(':', 1)
+        if int(count):
+            (users if kind == 'user' else groups)[conversation_id] = int(count)
+    group_ids = [group_id for group_id in group_ids if group_id in seen]
+    if group_ids:
+        for group_id, sent in zip(group_ids, client.hmget(group_sent_key, group_ids)):
+            count = int(sent or 0) - int(seen[group_id])
+            if count > 0:
+                group_id = group_id.decode('utf-8')
+                groups[group_id] = groups.get(group_id, 0) + count
+    return users, groups
+
+
+def add_group_member(client, group_id, user_id):
+    with client.pipeline(transaction=False) as pipe:
+        pipe.sadd(user_groups_key(user_id), group_id)
+        pipe.sadd(group_members_key(group_id), user_id)
+        pipe.execute()
+
+
+def remove_group_member(client, group_id, user_id):
+    with client.pipeline(transaction=False) as pipe:
+        pipe.srem(user_groups_key(user_id), group_id)
+        pipe.srem(group_members_key(group_id), user_id)
+        pipe.execute()
+
+
+def read_group_members(client, group_id):
+    # the ids of the members of the group, or None if they are not cached (the DB has to be read)
+    members = client.smembers(group_members_key(group_id))
+    if group_members_sentinel not in members:
+        return None
+    return [member.decode('utf-8') for member in members if member != group_members_sentinel]
+
+
+def write_group_members(client, group_id, member_ids):
+    # cache the members of the group read from the DB. added, not replaced, so a concurrent join is kept
+    key = group_members_key(group_id)
+    with client.pipeline(transaction=True) as pipe:
+        pipe.sadd(key, group_members_sentinel, *member_ids)
+        pipe.expire(key, ttl_seconds)
+        pipe.execute()
+
+
+def write_back(client, user_id, messages, complete_since, last_delivered):
+    """Cache messages read from the DB (read-through), so the next read of the user hits the cache.
+
+    messages are (timestamp_us, is_group, sending_user_id, message_text) tuples - all the messages of the
+    user since the score complete_since. Only the newest cache_length of them are kept. If they all fit,
+    complete_since is recorded by the watermark record: the oldest entry of the set, so the cache reads
+    as complete since then (until trimmed). Otherwise all of them are published for fill_result_seconds,
+    with the watermark, for read_messages to continue the user's messages with (if not too many). Everything
+    is added - never replaced - so messages cached concurrently by send / send_group are kept.
+
+    last_delivered is the score of the newest message the user has (or, if none, just before complete_since).
+    """
+    key = user_messages_key(user_id)
+    newest = heapq.nlargest(cache_length, messages, key=lambda message: message[0])
+    with client.pipeline(transaction=True) as pipe:
+        if newest:
+            pipe.zadd(key, {codec.encode(*message): message[0] for message in newest})
+        if len(newest) == len(messages):
+            # keeps an older watermark (the set is still complete since then)
+            pipe.zadd(key, {codec.watermark_record: complete_since}, lt=True)
+        elif len(messages) <= fill_result_length:
+            filled_key = fill_result_key(user_id)
+            pipe.delete(filled_key)
+            records = {codec.encode(*message): message[0] for message in messages}
+            records[codec.watermark_record] = complete_since
+            pipe.zadd(filled_key, records)
+            pipe.expire(filled_key, fill_result_seconds)
+        pipe.zremrangebyrank(key, 0, -cache_length - 1)
+        pipe.expire(key, ttl_seconds)
+        _mark_delivered(pipe, {user_id: last_delivered})
+        pipe.execute()
+
+
+def _mark_delivered(pipe, scores):
+    # user id -> the score of a message delivered to the user (concurrent sends may finish out of order, so the
+    # newest is kept)
+    for user_id, score in scores.items():
+        key = last_delivered_key(user_id)
+        pipe.zadd(key, {last_delivered_member: score}, gt=True)
+        pipe.expire(key, ttl_seconds)
+
+
+def _read_since(pipe, key, min_score):
+    # the messages since min_score (newest first) and the score of the oldest message
+    pipe.zrevrangebyscore(key, '+inf', min_score)
+    pipe.zrange(key, 0, 0, withscores=True, score_cast_func=int)
+
+
+def _complete_since(oldest, filled, filled_oldest):
+    # the score since which a log (complete since oldest) is complete, continued by the published refill: its
+    # watermark if the log reaches back to the refill's newest message (nothing was missed in between)
+    if filled and oldest <= filled[0][0]:
+        return min(oldest, filled_oldest[0][1])
+    return oldest
+
+
+def _read_legacy_list(records, min_score):
+    # the messages of a key in the list format (see legacy_lists_until)
+    messages = codec.decode_many(records)
+    return [message for message in messages if message[0] >= min_score], messages[-1][0]
+
+
+def _mark_groups_read(client, user_id, group_ids, sent, seen):
+    # the messages sent to the user's large groups (as read with their logs) are read now - see read_unread.
+    # a round trip only if there were new ones
+    changed = {group_id: count for group_id, count, seen_count in zip(group_ids, sent, seen)
+               if count is not None and count != seen_count}
+    if changed:
+        key = group_seen_key(user_id)
+        with client.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping=changed)
+            pipe.expire(key, unread_ttl_seconds)
+            pipe.execute()
+
+
+def read_messages(client, user_id, min_score):
+    """Return the cached messages of a user since min_score, the score since which the cache is complete, and the
+    doorbells to wait on for the deliveries after this read (see wait_for_delivery).
+
+    If nothing was delivered to the user (or to the user's large groups) since min_score, the (empty) result is
+    complete right away.
+    Otherwise the messages are decoded (see codec.decode_many) and ordered newest first. The user's own
+    messages are merged with the logs of the large groups the user is a member of. They are complete
+    since the newest of the oldest messages of each log, or None if the user's own messages are not
+    cached, or the log of a large group with messages since min_score (expired or evicted - the DB has to
+    be read). A refill published by write_back extends the logs
+    back to its watermark, as long as they still reach back into it (were not trimmed past it since). The
+    user's unread counters are reset (see read_unread).
+    """
+    own_key = user_messages_key(user_id)
+    # a transaction, so the unread counters are reset as of exactly the messages read
+    with client.pipeline(transaction=True) as pipe:
+        _read_since(pipe, own_key, min_score)
+        pipe.expire(own_key, ttl_seconds)
+        pipe.smembers(user_groups_key(user_id))
+        pipe.zscore(last_delivered_key(user_id), last_delivered_member)
+        pipe.delete(unread_key(user_id))
+        pipe.time()
+        _read_since(pipe, fill_result_key(user_id), min_score)
+        if time.time() < legacy_lists_until:
+            pipe.lrange(user_id, 0, -1)
+        (own_records, own_oldest, _, group_ids, last_delivered, _, now, filled_records, filled_oldest,
+         *legacy) = pipe.execute()
+    legacy_records = legacy[0] if legacy else None
+    doorbells = _doorbells(now, user_id)
+
+    own_idle = last_delivered is not None and last_delivered < min_score
+    if own_idle and not group_ids:
+        return [], min_score, doorbells
+
+    sources = []
+    if legacy_records and not own_idle:
+        sources.append(_read_legacy_list(legacy_records, min_score))
+    # all the messages since its watermark, as of the refill which published them
+    filled = codec.decode_many(filled_records) if filled_oldest else []
+    if own_idle:
+        # nothing in the user's own set since min_score - whether it is cached or not
+        sources.append(([], min_score))
+    elif own_oldest:
+        own_messages = codec.decode_many(own_records)
+        own_since = _complete_since(own_oldest[0][1], filled, filled_oldest)
+        if own_since < own_oldest[0][1]:
+            own_messages = sorted(set(own_messages).union(filled), key=lambda message: message[0], reverse=True)
+        sources.append((own_messages, own_since))
+    if not sources:
+        return [], None, doorbells
+
+    if group_ids:
+        group_ids = list(group_ids)
+        # a transaction, so the logs are read as of exactly the numbers of messages sent to the groups
+        with client.pipeline(transaction=True) as pipe:
+            for group_id in group_ids:
+                _read_since(pipe, group_log_key(group_id.decode('utf-8')), min_score)
+            pipe.zmscore(large_groups_key, group_ids)
+            pipe.hmget(group_sent_key, group_ids)
+            pipe.hmget(group_seen_key(user_id), group_ids)
+            *results, group_newest, sent, seen = pipe.execute()
+        _mark_groups_read(client, user_id, group_ids, sent, seen)
+        doorbells = _doorbells(now, user_id, [group_id.decode('utf-8') for group_id, newest
+                                              in zip(group_ids, group_newest) if newest is not None])
+        for group_records, group_oldest, newest in zip(results[::2], results[1::2], group_newest):
+            if newest is not None and newest < min_score:
+                # a large group without messages since min_score - its log (if any) adds nothing
+                continue
+            if not group_oldest:
+                # no log: a small group (its messages are in the user's own set), or a large one whose log expired
+                # (or was evicted) while it has messages since min_score
+                if newest is not None:
+                    return [], None, doorbells
+            else:
+                # fan-out on write never sends members their own messages, neither does the log
+                group_messages = [message for message in codec.decode_many(group_records) if message[2] != user_id]
+                # the refill has the group's messages too (merged with the user's own above)
+                sources.append((group_messages, _complete_since(group_oldest[0][1], filled, filled_oldest)))
+
+    complete_since = max(oldest for _, oldest in sources)
+    if len(sources) == 1:
+        return sources[0][0], complete_since, doorbells
+
+    # k-way merge of the (newest first) logs
+    messages = []
+    merged = heapq.merge(*(source_messages for source_messages, _ in sources), key=lambda message: message[0],
+                         reverse=True)
+    for message in merged:
+        if not messages or message != messages[-1]:
+            messages.append(message)
+    return messages, complete_since, doorbells
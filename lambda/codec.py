@@ -0,0 +1,86 @@
+import struct
+from datetime import datetime, timedelta
+
+record_version = 1
+is_group_flag = 0x01
+# the sender id is not a uuid: it follows the text (length-prefixed) instead of the 16 bytes of the header
+text_sender_flag = 0x02
+
+# not a message: its score marks the time since which a cached set of messages is complete
+watermark_record = b'\x00'
+
+# version, send time (epoch microseconds), flags, sending user id (uuid bytes), text length - then the text
+_header = struct.Struct('>BqB16sH')
+_sender_length = struct.Struct('>H')
+_no_uuid = bytes(16)
+
+_epoch = datetime(1970, 1, 1)
+_microsecond = timedelta(microseconds=1)
+
+
+def epoch_us(timestamp):
+    # exact, since it stays far below 2**53 (the scores of the sorted sets are doubles)
+    return (timestamp - _epoch) // _microsecond
+
+
+def from_epoch_us(timestamp_us):
+    return _epoch + timestamp_us * _microsecond
+
+
+def encode(timestamp_us, is_group, sending_user_id, message_text):
+    # the user ids are uuid strings - 16 bytes instead of 36. any other id is kept as it is, after the text
+    text = message_text.encode('utf-8')
+    flags = is_group_flag if is_group else 0
+    sender = _uuid_bytes(sending_user_id)
+    if sender is not None:
+        return _header.pack(record_version, timestamp_us, flags, sender, len(text)) + text
+    sender = sending_user_id.encode('utf-8')
+    return (_header.pack(record_version, timestamp_us, flags | text_sender_flag, _no_uuid, len(text)) + text +
+            _sender_length.pack(len(sender)) + sender)
+
+
+def decode_many(records):
+    """Decode cached records into (timestamp_us, is_group, sending_user_id, message_text) tuples.
+
+    The watermark record is skipped. Records cached before the binary format (the
+    '{timestamp}:: {is_group} {sender}:: {text}' strings) are recognized by their first byte and decoded as well.
+    """
+    unpack_from = _header.unpack_from
+    header_size = _header.size
+    messages = []
+    append = messages.append
+    for record in records:
+        if record == watermark_record:
+            continue
+        if record[0] != record_version:
+            append(_decode_legacy(record))
+            continue
+        _, timestamp_us, flags, sender, length = unpack_from(record)
+        end = header_size + length
+        if flags & text_sender_flag:
+            sending_user_id = record[end + _sender_length.size:].decode('utf-8')
+        else:
+            sending_user_id = _format_uuid(sender.hex())
+        append((timestamp_us, flags & is_group_flag, sending_user_id, record[header_size:end].decode('utf-8')))
+    return messages
+
+
+def _uuid_bytes(user_id):
+    # the 16 bytes of a uuid in its canonical form (lowercase, hyphenated - as decoded), None for any other id
+    if len(user_id) != 36:
+        return None
+    try:
+        raw = bytes.fromhex(user_id.replace('-', ''))
+    except ValueError:
+        return None
+    return raw if len(raw) == 16 and _format_uuid(raw.hex()) == user_id else None
+
+
+def _format_uuid(digits):
+    return f'{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}'
+
+
+def _decode_legacy(record):
+    timestamp, details, message_text = record.decode('utf-8').split(':: ', 2)
+    is_group, sending_user_id = details.split(' ', 1)
+    return epoch_us(datetime.fromisoformat(timestamp)), int(is_group), sending_user_id, message_text
@@ -0,0 +1,36 @@
+import json
+import outbox
+import resources
+import tracing
+
+safety_seconds = 5  # stop draining this long before the lambda times out
+
+
+@tracing.traced
+def drain_lambda(event, context):
+    # runs on a schedule in write-behind mode: inserts the messages sent since into the db
+    global result
+
+    try:
+        if context is not None:
+            seconds = context.get_remaining_time_in_millis() / 1000 - safety_seconds
+        else:
+            seconds = 0
+        seconds = float(event.get('seconds', seconds))
+        drained = outbox.drain(resources.get_db_connection(), resources.get_cache_client(), seconds)
+
+        # output
+        result = {
+            'statusCode': 200,
+            'body': json.dumps(f'success in draining messages: {drained} messages')
+        }
+
+        return result
+
+    except Exception as e:
+        resources.discard_if_broken(e)
+        result = {
+            'statusCode': 500,
+            'body': json.dumps(f"error in draining messages: {e}")
+        }
+        return result
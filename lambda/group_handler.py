@@ -1,43 +1,37 @@
 import json
-import uuid
 from datetime import datetime
-import pymysql
-import os
-import redis
+import cache
+import codec
+import ids
+import outbox
+import resources
+import tracing
 
 users_table = 'users_table'
 groups_table = 'groups_table'
 group_members_table = 'group_members_table'
 group_messages_table = 'group_messages_table'
-cache_length = 20
 
 
+@tracing.traced
 def create_group_lambda(event, context):
     global result
 
     try:
         # parse input
         group_name = event['queryStringParameters']['group_name']
+        tracing.mark('parse')
 
         # update db
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASS']
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                # create table
-                cursor.execute(f'CREATE DATABASE IF NOT EXISTS mydatabase;')
-                cursor.execute("USE mydatabase")
-                cursor.execute(
-                    f'CREATE TABLE IF NOT EXISTS {groups_table} (group_id VARCHAR(255) PRIMARY KEY, group_name VARCHAR(255));')
-                # check if group exists: no need, since the group-name is not unique here, just the group-id
-                # generate id
-                group_id = str(uuid.uuid4())
-                # record in table
-                cursor.execute(f"INSERT INTO {groups_table} (group_id, group_name) VALUES ('{group_id}', '{group_name}');")
-            connection.commit()
+        connection = resources.get_db_connection()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            # check if group exists: no need, since the group-name is not unique here, just the group-id
+            # generate id
+            group_id = ids.new_id()
+            # record in table
+            cursor.execute(f"INSERT INTO {groups_table} (group_id, group_name) VALUES ('{group_id}', '{group_name}');")
+        tracing.mark('insert')
 
         # output
         result = {
@@ -48,6 +42,7 @@ def create_group_lambda(event, context):
         return result
 
     except Exception as e:
+        resources.discard_if_broken(e)
         result = {
             'statusCode': 500,
             'body': json.dumps(f"error in creating group: {e}")
@@ -55,6 +50,7 @@ def create_group_lambda(event, context):
         return result
 
 
+@tracing.traced
 def update_group_lambda(event, context):
     global result
 
@@ -63,30 +59,30 @@ def update_group_lambda(event, context):
         user_id = event['queryStringParameters']['user_id']
         group_id = event['queryStringParameters']['group_id']
         to_be_added = bool(int(event['queryStringParameters']['to_be_added']))  # add/remove
+        tracing.mark('parse')
 
         # update db
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASS']
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                # create table
-                cursor.execute(f'CREATE DATABASE IF NOT EXISTS mydatabase;')
-                cursor.execute("USE mydatabase")
+        connection = resources.get_db_connection()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            # record in table
+            if to_be_added:
+                cursor.execute(
+                    f"INSERT INTO {group_members_table} (group_id, user_id) VALUES ('{group_id}', '{user_id}');")
+                action = 'user has been added'
+            else:
                 cursor.execute(
-                    f'CREATE TABLE IF NOT EXISTS {group_members_table} (group_id VARCHAR(255), user_id VARCHAR(255), PRIMARY KEY (group_id, user_id));')
-                # record in table
-                if to_be_added:
-                    cursor.execute(
-                        f"INSERT INTO {group_members_table} (group_id, user_id) VALUES ('{group_id}', '{user_id}');")
-                    action = 'user has been added'
-                else:
-                    cursor.execute(
-                        f"DELETE FROM {group_members_table} WHERE group_id='{group_id}' AND user_id='{user_id}';")
-                    action = 'user has been removed'
-            connection.commit()
+                    f"DELETE FROM {group_members_table} WHERE group_id='{group_id}' AND user_id='{user_id}';")
+                action = 'user has been removed'
+        tracing.mark('db')
+
+        # update the group's members and the user's groups (to read the logs of large groups) in cache
+        cache_client = resources.get_cache_client()
+        if to_be_added:
+            cache.add_group_member(cache_client, group_id, user_id)
+        else:
+            cache.remove_group_member(cache_client, group_id, user_id)
+        tracing.mark('cache')
 
         # output
         result = {
@@ -97,6 +93,7 @@ def update_group_lambda(event, context):
         return result
 
     except Exception as e:
+        resources.discard_if_broken(e)
         result = {
             'statusCode': 500,
             'body': json.dumps(f"error in updating group: {e}")
@@ -104,6 +101,7 @@ def update_group_lambda(event, context):
         return result
 
 
+@tracing.traced
 def send_group_lambda(event, context):
     global result
 
@@ -112,61 +110,65 @@ def send_group_lambda(event, context):
         sending_user_id = event['queryStringParameters']['sending_user_id']
         group_id = event['queryStringParameters']['group_id']
         message_text = event['queryStringParameters']['message_text']
+        too_long = outbox.too_long({'sending_user_id': sending_user_id, 'group_id': group_id,
+                                    'message_text': message_text})
+        if too_long:
+            result = {
+                'statusCode': 400,
+                'body': json.dumps(f'{too_long} is longer than {outbox.max_column_length} characters')
+            }
+            return result
+        tracing.mark('parse')
 
         # update db
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASS']
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                # create table
-                cursor.execute(f'CREATE DATABASE IF NOT EXISTS mydatabase;')
-                cursor.execute("USE mydatabase")
-                cursor.execute(f"""
-                CREATE TABLE IF NOT EXISTS {group_messages_table} (
-                message_id VARCHAR(255) PRIMARY KEY,
-                sending_user_id VARCHAR(255),
-                group_id VARCHAR(255),
-                message_text VARCHAR(255),
-                timestamp TIMESTAMP
-                );
-                """)
-
-                # message details
-                message_id = str(uuid.uuid4())
-                message_timestamp = datetime.now()
-
-                # record
+        connection = resources.get_db_connection()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            # message details
+            message_id = ids.new_id()
+            message_timestamp = datetime.now()
+            # the cached record - encoded before anything is stored, so a message which can't be cached is not sent
+            is_group = 1
+            score = codec.epoch_us(message_timestamp)
+            value = codec.encode(score, is_group, sending_user_id, message_text)
+
+            # record (in write-behind mode, the drainer records it)
+            if not outbox.write_behind:
                 cursor.execute(f"""
                 INSERT INTO {group_messages_table} 
                 (message_id, sending_user_id, group_id, message_text, timestamp) VALUES 
-                ('{message_id}', '{sending_user_id}', '{group_id}', 
-                '{message_text}', '{str(message_timestamp)}');
-                """)
-
-                # get users in the group
+                (%s, %s, %s, %s, %s);
+                """, (ids.to_bytes(message_id), sending_user_id, group_id, message_text, message_timestamp))
+            tracing.mark('insert')
+
+            # get users in the group (from the cache, unless they are not cached)
+            cache_client = resources.get_cache_client()
+            member_ids = cache.read_group_members(cache_client, group_id)
+            if member_ids is None:
                 cursor.execute(f"""SELECT user_id FROM {group_members_table} WHERE group_id='{group_id}';""")
-                records = cursor.fetchall()
-
-            connection.commit()
-
-        # send to cache
-        redis_host = os.environ['REDIS_HOST']
-        cache_client = redis.Redis(host=redis_host, port=6379, db=0)
-        is_group = 1
-        value = f'{str(message_timestamp)}:: {is_group} {sending_user_id}:: {message_text}'
-        # cache_client.set(receiving_user_id, value)
-        # cache_client.delete(receiving_user_id)
-        for row in records:
-            receiving_user_id = row[0]
-            if receiving_user_id != sending_user_id:
-                # push the new message
-                cache_client.lpush(receiving_user_id, value)
-                # remove the oldest message
-                if cache_client.llen(receiving_user_id) > cache_length:
-                    cache_client.rpop(receiving_user_id)
+                member_ids = [row[0] for row in cursor.fetchall()]
+                cache.write_group_members(cache_client, group_id, member_ids)
+            tracing.mark('members')
+
+        # send to cache, count it as unread (and in write-behind mode send it to the stream of the drainer), in the
+        # same transaction
+        large_group = len(member_ids) > cache.large_group_size
+        receiving_user_ids = [member_id for member_id in member_ids if member_id != sending_user_id]
+
+        def extra(pipe):
+            if outbox.write_behind:
+                outbox.queue(pipe, message_id, is_group, sending_user_id, group_id, message_text, score)
+            if large_group:
+                cache.count_group_unread(pipe, group_id, sending_user_id)
+            else:
+                cache.count_unread(pipe, receiving_user_ids, f'group:{group_id}')
+
+        if large_group:
+            # one copy in the group's log, the members merge it when reading
+            cache.append_group_log(cache_client, group_id, member_ids, value, score, extra)
+        else:
+            cache.append_messages(cache_client, receiving_user_ids, value, score, extra)
+        tracing.mark('cache')
 
         # output
         result = {
@@ -177,6 +179,7 @@ def send_group_lambda(event, context):
         return result
 
     except Exception as e:
+        resources.discard_if_broken(e)
         result = {
             'statusCode': 500,
             'body': json.dumps(f"error in sending to group: {e}")
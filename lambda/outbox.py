@@ -0,0 +1,182 @@
+import os
+import time
+import pymysql
+import redis
+import codec
+import ids
+import sequence
+
+# write-behind mode: the send handlers only append the messages to a Redis stream (and to the caches),
+# and the drain lambda inserts them into the DB in batches. see 'Write-behind' in the README for the guarantees
+write_behind = os.environ.get('WRITE_BEHIND', '0') == '1'
+
+stream_key = 'messages_stream'
+dead_letters_key = 'messages_dead_letters'  # the messages the DB kept rejecting, with the error
+drainers_group = 'drainers'
+drainer_name = 'drainer'  # a single consumer - the drain lambda runs one at a time
+drain_batch_size = 500
+drain_block_ms = 1000  # how long an idle drainer waits for new messages at a time
+max_deliveries = 5  # a message the DB rejected this many times is moved to the dead letters
+max_column_length = 255  # the VARCHAR(255) columns of the messages tables (see schema.py)
+
+user_messages_table = 'user_messages_table'
+group_messages_table = 'group_messages_table'
+
+# the same message may be drained twice (e.g. after a failure before acknowledging it) - its id makes it a no-op.
+# only the duplicate key is ignored (not INSERT IGNORE, which would also store a message the DB rejects, e.g. one
+# too long, truncated - instead of rejecting it, see drain_batch)
+insert_queries = {
+    0: f"""
+    INSERT INTO {user_messages_table}
+    (message_id, sending_user_id, receiving_user_id, message_text, timestamp, seq) VALUES
+    (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE message_id=message_id
+    """,
+    1: f"""
+    INSERT INTO {group_messages_table}
+    (message_id, sending_user_id, group_id, message_text, timestamp) VALUES
+    (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE message_id=message_id
+    """,
+}
+
+
+def pending_key(is_group, receiving_id):
+    # the messages to a user / group which are not in the DB yet, so reads from the DB still see them
+    return f'pending_group:{receiving_id}' if is_group else f'pending:{receiving_id}'
+
+
+def too_long(fields):
+    # the name of the first of fields (name -> value) the messages tables can't store, or None. checked before
+    # sending - in write-behind mode the DB only sees the message when the drainer inserts it
+    return next((name for name, value in fields.items() if len(value) > max_column_length), None)
+
+
+def queue(pipe, message_id, is_group, sending_user_id, receiving_id, message_text, timestamp_us, seq=None):
+    # queue the commands which enqueue one message on pipe (within the transaction which caches the message).
+    # seq: the number of a message to a user (see sequence.py)
+    fields = {'message_id': message_id, 'is_group': int(is_group), 'sending_user_id': sending_user_id,
+              'receiving_id': receiving_id, 'message_text': message_text, 'timestamp_us': timestamp_us}
+    if seq is not None:
+        fields['seq'] = seq
+    pipe.xadd(stream_key, fields)
+    record = codec.encode(timestamp_us, is_group, sending_user_id, message_text)
+    pipe.zadd(pending_key(is_group, receiving_id), {record: timestamp_us})
+    if seq is not None:
+        pipe.zadd(sequence.pending_key(receiving_id), {record: seq})
+
+
+def read_pending(client, user_id, group_ids, min_score, max_score=None):
+    # the messages to the user and to the user's groups since min_score (and before max_score) not drained yet,
+    # as (timestamp_us, is_group, sending_user_id, message_text) tuples
+    keys = [pending_key(0, user_id)] + [pending_key(1, group_id) for group_id in group_ids]
+    with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.zrangebyscore(key, min_score, '+inf' if max_score is None else f'({max_score}')
+        results = pipe.execute()
+    return [message for records in results for message in codec.decode_many(records)]
+
+
+def _ensure_consumer_group(client):
+    try:
+        client.xgroup_create(stream_key, drainers_group, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if not str(e).startswith('BUSYGROUP'):
+            raise
+
+
+def drain_batch(connection, client, last_id='>', block_ms=None):
+    """Insert one batch of messages from the stream into the DB, returns the ids of the stream entries read.
+
+    last_id '>' reads new entries, '0' (or the last id read) the entries read before but never acknowledged (a
+    former run failed midway, or the DB rejected their messages). The entries are acknowledged and deleted - and
+    their messages removed from the pending sets - only after the insert. A message the DB rejects stays pending,
+    and once it was read max_deliveries times it is moved to the dead letters instead of blocking the drain.
+    """
+    response = client.xreadgroup(drainers_group, drainer_name, {stream_key: last_id},
+                                 count=drain_batch_size, block=block_ms)
+    entries = response[0][1] if response else []
+    if not entries:
+        return []
+
+    rows = {0: [], 1: []}
+    messages = {}  # entry id -> the fields of its message
+    pending = {}  # entry id -> the records of its message in the pending sets
+    for entry_id, fields in entries:
+        if not fields:
+            # deleted (already drained)
+            continue
+        fields = {key.decode('utf-8'): value.decode('utf-8') for key, value in fields.items()}
+        messages[entry_id] = fields
+        is_group = int(fields['is_group'])
+        timestamp_us = int(fields['timestamp_us'])
+        row = (ids.to_bytes(fields['message_id']), fields['sending_user_id'], fields['receiving_id'],
+               fields['message_text'], codec.from_epoch_us(timestamp_us))
+        record = codec.encode(timestamp_us, is_group, fields['sending_user_id'], fields['message_text'])
+        pending[entry_id] = [(pending_key(is_group, fields['receiving_id']), record)]
+        if not is_group:
+            # queued before the messages were numbered, it has none
+            seq = int(fields['seq']) if 'seq' in fields else None
+            row += (seq,)
+            if seq is not None:
+                pending[entry_id].append((sequence.pending_key(fields['receiving_id']), record))
+        rows[is_group].append((entry_id, row))
+
+    rejected = {}  # entry id -> the error the DB rejected its message with
+    with connection.cursor() as cursor:
+        for is_group, table_rows in rows.items():
+            if not table_rows:
+                continue
+            try:
+                cursor.executemany(insert_queries[is_group], [row for _, row in table_rows])
+            except (pymysql.DataError, pymysql.IntegrityError):
+                # a message the DB rejects fails the whole statement - insert them one at a time to find it
+                for entry_id, row in table_rows:
+                    try:
+                        cursor.execute(insert_queries[is_group], row)
+                    except (pymysql.DataError, pymysql.IntegrityError) as e:
+                        rejected[entry_id] = e
+
+    dead = []
+    if rejected:
+        # how many times each entry was read (the entries are in order of their ids)
+        deliveries = client.xpending_range(stream_key, drainers_group, entries[0][0], entries[-1][0], len(entries))
+        deliveries = {delivery['message_id']: delivery['times_delivered'] for delivery in deliveries}
+        dead = [entry_id for entry_id in rejected if deliveries.get(entry_id, 0) >= max_deliveries]
+
+    entry_ids = [entry_id for entry_id, _ in entries if entry_id not in rejected or entry_id in dead]
+    if entry_ids:
+        with client.pipeline(transaction=True) as pipe:
+            for entry_id in dead:
+                pipe.xadd(dead_letters_key, {**messages[entry_id], 'error': str(rejected[entry_id])})
+            pipe.xack(stream_key, drainers_group, *entry_ids)
+            pipe.xdel(stream_key, *entry_ids)
+            for entry_id in entry_ids:
+                for key, record in pending.get(entry_id, ()):
+                    pipe.zrem(key, record)
+            pipe.execute()
+
+    return [entry_id for entry_id, _ in entries]
+
+
+def drain(connection, client, seconds):
+    # drain the stream, then keep waiting for new messages until the time is up. returns the number drained
+    deadline = time.monotonic() + seconds
+    _ensure_consumer_group(client)
+
+    # first what a failed run left behind (and the messages the DB rejected, until they are dead letters) - from
+    # the last entry read on, as the rejected ones stay pending
+    drained = 0
+    last_id = '0'
+    while entry_ids := drain_batch(connection, client, last_id):
+        drained += len(entry_ids)
+        last_id = entry_ids[-1]
+
+    while True:
+        # when there is time left, an idle drainer waits for new messages
+        time_left_ms = int((deadline - time.monotonic()) * 1000)
+        block_ms = min(drain_block_ms, time_left_ms) if time_left_ms > 0 else None
+        count = len(drain_batch(connection, client, block_ms=block_ms))
+        drained += count
+        if not count and time_left_ms <= 0:
+            return drained
@@ -1,83 +1,265 @@
 import json
-import os
-import redis
-import pymysql
+import time
 from datetime import datetime
+import cache
+import codec
+import outbox
+import resources
+import response
+import sequence
+import tracing
 
 group_members_table = 'group_members_table'
 group_messages_table = 'group_messages_table'
 user_messages_table = 'user_messages_table'
-ttl_seconds = 86400  # Key will expire in a day
 
+# messages (from users and groups), served by the indexes of schema migration 2
+db_read_query = f"""
+SELECT timestamp, 0 as is_group, sending_user_id, message_text FROM {user_messages_table}
+WHERE receiving_user_id=%(user_id)s
+AND timestamp >= %(min_timestamp)s
+UNION ALL
+SELECT timestamp, 1 as is_group, sending_user_id, message_text FROM {group_messages_table}
+JOIN {group_members_table} ON {group_messages_table}.group_id={group_members_table}.group_id
+WHERE {group_members_table}.user_id=%(user_id)s
+AND timestamp >= %(min_timestamp)s
+"""
 
+# the same, only for the messages older than the ones the cache holds
+db_gap_query = f"""
+SELECT timestamp, 0 as is_group, sending_user_id, message_text FROM {user_messages_table}
+WHERE receiving_user_id=%(user_id)s
+AND timestamp >= %(min_timestamp)s AND timestamp < %(max_timestamp)s
+UNION ALL
+SELECT timestamp, 1 as is_group, sending_user_id, message_text FROM {group_messages_table}
+JOIN {group_members_table} ON {group_messages_table}.group_id={group_members_table}.group_id
+WHERE {group_members_table}.user_id=%(user_id)s
+AND timestamp >= %(min_timestamp)s AND timestamp < %(max_timestamp)s
+"""
+
+
+@tracing.traced
 def read_messages_lambda(event, context):
     global result
+    fill_lock = None
+    locked = False
+
+    try:
+        # parse input
+        user_id = event['queryStringParameters']['user_id']
+        # optional: the messages to the user after this number of the user's sequence, instead of since
+        # min_timestamp (see sequence.py). the group messages are still read since min_timestamp, if given
+        after_seq = event['queryStringParameters'].get('after_seq')
+        after_seq = None if after_seq is None else int(after_seq)
+        # '2024-07-01 09:00:00.0', required unless after_seq is given
+        if after_seq is None:
+            min_timestamp = event['queryStringParameters']['min_timestamp']
+        else:
+            min_timestamp = event['queryStringParameters'].get('min_timestamp')
+        # long polling (optional): with no new messages, wait up to this long for one (at most LONG_POLL_SECONDS)
+        wait_seconds = min(float(event['queryStringParameters'].get('wait_seconds', 0)), cache.long_poll_seconds)
+        tracing.mark('parse')
+
+        # cache
+        client = resources.get_cache_client()
+        deadline = time.monotonic() + wait_seconds
+        if min_timestamp is None:
+            # only the messages to the user by their numbers - nothing is read by time
+            result = _sequenced_response(client, user_id, after_seq, deadline)
+            tracing.mark('output')
+            return result
+        min_score = codec.epoch_us(datetime.fromisoformat(min_timestamp))
+        while True:
+            # the user's own messages merged with the logs of the user's large groups (newest first)
+            cache_messages, complete_since, doorbells = cache.read_messages(client, user_id, min_score)
+            cached = [message for message in cache_messages
+                      if complete_since is not None and message[0] >= complete_since]
+            tracing.mark('cache')
+            # check messages in cache
+            if complete_since is None or complete_since > min_score:
+                if locked:
+                    break
+                # single-flight: one invocation at a time reads the user's messages from the db and refills the
+                # cache (see cache.fill_lock), the others wait for it to release the lock and read the cache
+                # again. so does the one which takes the lock, in case the cache was refilled just before
+                if fill_lock is None:
+                    fill_lock = cache.fill_lock(client, user_id)
+                    fill_deadline = time.monotonic() + cache.fill_wait_seconds
+                locked = fill_lock.acquire(blocking=False)
+                waited = locked or cache.wait_for_fill(fill_lock, fill_deadline - time.monotonic())
+                tracing.mark('lock')
+                if not waited:
+                    # the refill takes too long - read the db too
+                    break
+                continue
+            if locked:
+                cache.release_fill_lock(fill_lock)
+                locked = False
+            time_left = deadline - time.monotonic()
+            if cached or time_left <= 0:
+                sequenced = None if after_seq is None else _read_sequenced(client, user_id, after_seq)
+                result = _messages_response('cache', cached, sequenced=sequenced)
+                tracing.mark('output')
+                return result
+            # nothing new yet - wait for a delivery to the user or to the user's large groups (or for the time to
+            # be up), then read again
+            cache.wait_for_delivery(client, doorbells, time_left)
+            tracing.mark('wait')
+
+        # if the timestamp not in cache (either empty cache or doesn't include all required messages)
+        # then read from the db - only the messages older than the cached ones, if there are any
+        connection = resources.get_db_connection()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            if complete_since is None:
+                cursor.execute(db_read_query, {'user_id': user_id, 'min_timestamp': min_timestamp})
+                db_records = cursor.fetchall()
+            else:
+                cursor.execute(db_gap_query, {'user_id': user_id, 'min_timestamp': min_timestamp,
+                                              'max_timestamp': codec.from_epoch_us(complete_since)})
+                db_records = cursor.fetchall()
+
+            if outbox.write_behind:
+                # the messages sent but not drained into the db yet
+                cursor.execute(f"SELECT group_id FROM {group_members_table} WHERE user_id=%s", (user_id,))
+                group_ids = [row[0] for row in cursor.fetchall()]
+                pending = [(codec.from_epoch_us(timestamp_us), is_group, sending_user_id, message_text)
+                           for timestamp_us, is_group, sending_user_id, message_text
+                           in outbox.read_pending(client, user_id, group_ids, min_score, complete_since)]
+                # a message being drained right now may be in both
+                drained = set(db_records)
+                db_records = list(db_records) + [record for record in pending if record not in drained]
+
+            # older than the cached messages, if any
+            rows = sorted(db_records, key=lambda row: row[0], reverse=True)
+            source = 'db' if complete_since is None else 'cache and db'
+        tracing.mark('db')
+
+        # read-through: cache what was read (with the cached messages it completes), so the next read (a minute
+        # later) hits the cache - and the reads waiting for this one (see cache.write_back).
+        # the user's own group messages are not cached for the user (as in send_group)
+        # the newest message also becomes the user's last delivered one (if older than the reads to come,
+        # they return right away)
+        if cached:
+            last_delivered = cached[0][0]
+        else:
+            last_delivered = codec.epoch_us(rows[0][0]) if rows else min_score - 1
+        cache.write_back(client, user_id, cached + [
+            (codec.epoch_us(timestamp), is_group, sending_user_id, message_text)
+            for timestamp, is_group, sending_user_id, message_text in db_records
+            if not (is_group and sending_user_id == user_id)], min_score, last_delivered)
+        tracing.mark('write_back')
+        if locked:
+            # the others may read the cache now
+            cache.release_fill_lock(fill_lock)
+            locked = False
+
+        # output
+        sequenced = None if after_seq is None else _read_sequenced(client, user_id, after_seq)
+        result = _messages_response(source, cached, rows, sequenced)
+        tracing.mark('output')
+
+        return result
+
+    except Exception as e:
+        resources.discard_if_broken(e)
+        result = {
+            'statusCode': 500,
+            'body': json.dumps(f"error in reading messages: {e}")
+        }
+        return result
+
+    finally:
+        if locked:
+            cache.release_fill_lock(fill_lock)
+
+
+def _read_sequenced(client, user_id, after_seq):
+    # the messages to the user after after_seq (newest first) from the cache, or else from the db, and where from
+    messages, complete = sequence.read_after(client, user_id, after_seq)
+    source = 'cache'
+    if not complete:
+        with resources.get_db_connection().cursor() as cursor:
+            cursor.execute(sequence.db_read_query, (user_id, after_seq))
+            messages = [(seq, codec.epoch_us(timestamp), sending_user_id, message_text)
+                        for seq, timestamp, sending_user_id, message_text in cursor.fetchall()]
+        if outbox.write_behind:
+            # the messages sent but not drained into the db yet (a message being drained right now may be in both)
+            drained = {message[0] for message in messages}
+            messages += [message for message in sequence.read_pending_after(client, user_id, after_seq)
+                         if message[0] not in drained]
+        messages.sort(reverse=True)
+        sequence.write_back(client, user_id, messages)
+        source = 'db'
+    return sequence.contiguous(messages, after_seq, codec.epoch_us(datetime.now())), source
+
+
+def _sequenced_response(client, user_id, after_seq, deadline):
+    # the messages to the user after after_seq alone, waiting for one until the deadline (long polling)
+    while True:
+        # the rings after this read, if it may wait
+        doorbells = cache.doorbells(client, user_id) if deadline > time.monotonic() else None
+        sequenced = _read_sequenced(client, user_id, after_seq)
+        tracing.mark('read_sequenced')
+        time_left = deadline - time.monotonic()
+        if sequenced[0] or time_left <= 0:
+            cache.mark_users_read(client, user_id, {message[2] for message in sequenced[0]})
+            return _messages_response(sequenced[1], [], sequenced=sequenced)
+        cache.wait_for_delivery(client, doorbells, time_left)
+        tracing.mark('wait')
+
+
+def _messages_response(source, cached, rows=(), sequenced=None):
+    # a JSON array of the messages, newest first (see response.messages_body). where they were read from is
+    # in a header. with sequenced (the messages to the user read by their numbers, and where from), the messages
+    # to the user read by time are left out, and the number of the last one is in a header (the next after_seq)
+    headers = {'Content-Type': 'application/json'}
+    messages = ()
+    if sequenced is not None:
+        messages, sequenced_source = sequenced
+        cached = [message for message in cached if message[1]]
+        rows = [row for row in rows if row[1]]
+        if sequenced_source != source:
+            source = 'cache and db'
+        if messages:
+            headers['X-Last-Seq'] = str(messages[0][0])
+    headers['X-Messages-Source'] = source
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': response.messages_body(cached, rows, messages)
+    }
+
+
+@tracing.traced
+def inbox_summary_lambda(event, context):
+    # the user's unread messages by conversation, from the cache alone - a cheap poll, after which the client
+    # reads the messages only if there are new ones
+    global result
 
     try:
         # parse input
         user_id = event['queryStringParameters']['user_id']
-        min_timestamp = event['queryStringParameters']['min_timestamp']  # '2024-07-01 09:00:00.0'
+        tracing.mark('parse')
 
         # cache
-        redis_host = os.environ['REDIS_HOST']
-        client = redis.Redis(host=redis_host, port=6379, db=0)
-        # records = client.get(user_id)
-        cache_messages = client.lrange(user_id, 0, -1)
-        # ttl
-        client.expire(user_id, ttl_seconds)
-        # check messages in cache
-        if cache_messages:
-            min_timestamp_datetime = datetime.strptime(min_timestamp, '%Y-%m-%d %H:%M:%S.%f')
-            oldest_message = cache_messages[-1]
-            oldest_message_timestamp = datetime.strptime(oldest_message.decode('utf-8').split('::')[0], '%Y-%m-%d %H:%M:%S.%f')
-            # print(str(oldest_message_timestamp))
-            if oldest_message_timestamp <= min_timestamp_datetime:
-                records = []
-                for message in cache_messages:
-                    message_timestamp = datetime.strptime(message.decode('utf-8').split('::')[0], '%Y-%m-%d %H:%M:%S.%f')
-                    if message_timestamp >= min_timestamp_datetime:
-                        records.append(message)
-                    else:
-                        break
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(f'success in reading messages via cache: {records}')
-                }
-
-        # if the timestamp not in cache (eirther empty cache or doesn't include all required messages)
-        # then read from the db
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASS']
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute("USE mydatabase")
-                # messages (from users and groups)
-                cursor.execute(f"""
-                SELECT timestamp, 0 as is_group, sending_user_id, message_text FROM {user_messages_table} 
-                WHERE receiving_user_id='{user_id}'
-                AND timestamp >= '{min_timestamp}'
-                UNION
-                SELECT timestamp, 1 as is_group, sending_user_id, message_text FROM {group_messages_table} 
-                JOIN {group_members_table} ON {group_messages_table}.group_id={group_members_table}.group_id
-                WHERE {group_members_table}.user_id='{user_id}'
-                AND timestamp >= '{min_timestamp}'
-                """)
-                records = cursor.fetchall()
+        users, groups = cache.read_unread(resources.get_cache_client(), user_id)
+        tracing.mark('cache')
 
         # output
         result = {
             'statusCode': 200,
-            'body': json.dumps(f'success in reading messages via db: {str(records)}')
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'total': sum(users.values()) + sum(groups.values()), 'users': users,
+                                'groups': groups})
         }
 
         return result
 
     except Exception as e:
+        resources.discard_if_broken(e)
         result = {
             'statusCode': 500,
-            'body': json.dumps(f"error in reading messages: {e}")
+            'body': json.dumps(f"error in summarizing the inbox: {e}")
         }
         return result
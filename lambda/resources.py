@@ -0,0 +1,109 @@
+import os
+import time
+import pymysql
+import redis
+from pymysql.constants import ER
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+import schema
+import tracing
+
+cache_port = 6379
+idle_check_seconds = 30  # a reused connection is pinged only after being idle this long
+
+# shared by every invocation that lands on the same (warm) container
+_db_connection = None
+_db_last_used = 0.0
+_cache_pool = None
+
+
+def get_db_connection():
+    # lazily open one connection per container and reuse it across invocations
+    global _db_connection, _db_last_used
+
+    now = time.monotonic()
+    if _db_connection is None:
+        _db_connection = _connect_db()
+    elif now - _db_last_used > idle_check_seconds:
+        # the server may have dropped an idle connection - ping reconnects transparently
+        _db_connection.ping(reconnect=True)
+        tracing.count_db()
+    _db_last_used = now
+
+    return _db_connection
+
+
+def _connect_db():
+    kwargs = dict(
+        host=os.environ['DB_HOST'],
+        user=os.environ['DB_USER'],
+        password=os.environ['DB_PASS'],
+        autocommit=True
+    )
+    if tracing.enabled:
+        kwargs['cursorclass'] = tracing.CountingCursor
+    try:
+        # the database is selected at connect time, so the handlers never need 'USE'
+        connection = pymysql.connect(database=schema.db_name, **kwargs)
+    except pymysql.OperationalError as e:
+        if e.args[0] != ER.BAD_DB_ERROR:
+            raise
+        # first deployment - create the database and connect again
+        with pymysql.connect(**kwargs) as bootstrap_connection:
+            schema.create_database(bootstrap_connection)
+        connection = pymysql.connect(database=schema.db_name, **kwargs)
+
+    try:
+        schema.ensure_schema(connection)
+    except Exception:
+        connection.close()
+        raise
+
+    return connection
+
+
+def discard_db_connection():
+    # drop the shared connection (e.g. after an error), the next call opens a fresh one
+    global _db_connection
+
+    if _db_connection is not None:
+        try:
+            _db_connection.close()
+        except Exception:
+            pass
+        _db_connection = None
+
+
+def discard_if_broken(error):
+    # a connection-level failure must not be handed over to the next invocation
+    if isinstance(error, (pymysql.OperationalError, pymysql.InterfaceError)):
+        discard_db_connection()
+
+
+def get_cache_client():
+    # the pool keeps its sockets open between invocations of a warm container
+    global _cache_pool
+
+    if _cache_pool is None:
+        _cache_pool = redis.ConnectionPool(
+            host=os.environ['REDIS_HOST'],
+            port=cache_port,
+            db=0,
+            health_check_interval=idle_check_seconds,
+            retry=Retry(NoBackoff(), 1),
+            retry_on_error=[redis.exceptions.ConnectionError],
+            # counts the round trips when tracing
+            connection_class=tracing.CountingConnection if tracing.enabled else redis.Connection
+        )
+
+    return redis.Redis(connection_pool=_cache_pool)
+
+
+def close_all():
+    # release every shared connection (the next invocation behaves like a cold start)
+    global _cache_pool
+
+    discard_db_connection()
+    if _cache_pool is not None:
+        _cache_pool.disconnect()
+        _cache_pool = None
@@ -0,0 +1,41 @@
+import io
+from json.encoder import encode_basestring_ascii
+import codec
+
+_booleans = ('false', 'true')
+
+
+def messages_body(cached=(), rows=(), sequenced=()):
+    """The JSON array of the messages read: the sequenced ones, then the cached ones, then the DB rows.
+
+    cached are (timestamp_us, is_group, sending_user_id, message_text) tuples (see codec.decode_many), rows are
+    (timestamp, is_group, sending_user_id, message_text) DB rows. Each message becomes
+    {"timestamp_us": ..., "is_group": ..., "sending_user_id": ..., "message_text": ...}, written straight into
+    a single buffer (no intermediate list of dicts as for json.dumps, nor a copy of the whole buffer).
+    sequenced are (seq, timestamp_us, sending_user_id, message_text) messages to the user (see sequence.py),
+    which get a "seq" first.
+    """
+    # ascii only (encode_basestring_ascii escapes the rest), so the bytes are the str
+    buffer = io.BytesIO()
+    write = buffer.write
+    write(b'[')
+    separator = ''
+    for seq, timestamp_us, sending_user_id, message_text in sequenced:
+        write(f'{separator}{{"seq":{seq},"timestamp_us":{timestamp_us},"is_group":false,'
+              f'"sending_user_id":{encode_basestring_ascii(sending_user_id)},'
+              f'"message_text":{encode_basestring_ascii(message_text)}}}'.encode('ascii'))
+        separator = ','
+    for timestamp_us, is_group, sending_user_id, message_text in cached:
+        write(f'{separator}{{"timestamp_us":{timestamp_us},"is_group":{_booleans[is_group]},'
+              f'"sending_user_id":{encode_basestring_ascii(sending_user_id)},'
+              f'"message_text":{encode_basestring_ascii(message_text)}}}'.encode('ascii'))
+        separator = ','
+    epoch_us = codec.epoch_us
+    for timestamp, is_group, sending_user_id, message_text in rows:
+        write(f'{separator}{{"timestamp_us":{epoch_us(timestamp)},"is_group":{_booleans[is_group]},'
+              f'"sending_user_id":{encode_basestring_ascii(sending_user_id)},'
+              f'"message_text":{encode_basestring_ascii(message_text)}}}'.encode('ascii'))
+        separator = ','
+    write(b']')
+    with buffer.getbuffer() as body:
+        return str(body, 'ascii')
@@ -0,0 +1,126 @@
+import os
+from datetime import date
+
+# the messages tables are partitioned by the month of their timestamp (schema migration 7). the expired messages
+# are dropped (or archived) a whole month at a time - a change of metadata instead of deleting rows - and the
+# reads, which always filter by time, only visit the partitions of the months they ask for (partition pruning),
+# so they don't slow down as the history grows
+tables = ['user_messages_table', 'group_messages_table']
+
+# the months of messages kept (RETENTION_MONTHS, 0 - forever). a month is dropped once all of it is older
+retention_months = int(os.environ.get('RETENTION_MONTHS', '0'))
+# with RETENTION_ARCHIVE=1 an expired month is moved into a table of its own ({table}_archive_{yyyymm}) instead
+# of being dropped, to be exported (e.g. dumped to S3) and dropped by whoever needs it
+archive = os.environ.get('RETENTION_ARCHIVE', '0') == '1'
+# the months partitioned ahead of time, so a missed maintenance run or two don't matter
+months_ahead = 3
+
+# the messages from before the table was partitioned, in one partition (dropped once all of them expired)
+history_partition = 'p_history'
+# the catch-all after the last month. empty as long as the maintenance runs, which keeps splitting it cheap
+future_partition = 'p_future'
+
+partitions_query = """
+SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND PARTITION_NAME IS NOT NULL
+ORDER BY PARTITION_ORDINAL_POSITION
+"""
+
+
+def month_start(day, months=0):
+    # the first day of day's month, months later (or earlier)
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'p{month:%Y%m}'
+
+
+def partition_tables(cursor, today=None):
+    """Partition the messages tables (schema migration 7): the history, this month and the next ones, the rest.
+
+    The history is partitioned as it is, in one go - the table is copied once.
+    """
+    this_month = month_start(today or date.today())
+    for table in tables:
+        definitions = [_definition(history_partition, this_month)]
+        definitions += _month_definitions(this_month, month_start(this_month, months_ahead + 1))
+        cursor.execute(f"ALTER TABLE {table} PARTITION BY RANGE COLUMNS (timestamp) ({', '.join(definitions)})")
+
+
+def read_partitions(cursor, table):
+    # the partitions of the table, oldest first: (name, the day it ends before - None for the catch-all)
+    cursor.execute(partitions_query, (table,))
+    return [(name, None if bound == 'MAXVALUE' else date.fromisoformat(bound.strip("'")[:10]))
+            for name, bound in cursor.fetchall()]
+
+
+def maintain(connection, today=None):
+    """Create the partitions of the next months_ahead months and drop (or archive) the expired ones.
+
+    Returns the names ('table.partition') of the partitions created and of the ones expired. Safe to run again:
+    it only does what is missing, including the months missed while it did not run. Tables which are not
+    partitioned yet (schema migration 7 pending) are left alone.
+    """
+    today = today or date.today()
+    created = []
+    expired = []
+    with connection.cursor() as cursor:
+        for table in tables:
+            partitions = read_partitions(cursor, table)
+            if not partitions:
+                continue
+            created += _create_ahead(cursor, table, partitions, today)
+            if retention_months:
+                expired += _expire(cursor, table, partitions, month_start(today, -retention_months))
+    return created, expired
+
+
+def _definition(name, bound):
+    return f"PARTITION {name} VALUES LESS THAN ('{bound:%Y-%m-%d}')"
+
+
+def _month_definitions(start, end):
+    # a partition per month from start up to end, and the catch-all after them
+    definitions = []
+    while start < end:
+        definitions.append(_definition(partition_name(start), month_start(start, 1)))
+        start = month_start(start, 1)
+    definitions.append(f'PARTITION {future_partition} VALUES LESS THAN (MAXVALUE)')
+    return definitions
+
+
+def _create_ahead(cursor, table, partitions, today):
+    last = max(bound for _, bound in partitions if bound is not None)
+    end = month_start(today, months_ahead + 1)
+    if last >= end:
+        return []
+    definitions = _month_definitions(last, end)
+    cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION {future_partition} INTO ({', '.join(definitions)})")
+    return [f'{table}.{definition.split()[1]}' for definition in definitions[:-1]]
+
+
+def _expire(cursor, table, partitions, cutoff):
+    names = [name for name, bound in partitions if bound is not None and bound <= cutoff]
+    if not names:
+        return []
+    if archive:
+        for name in names:
+            _archive_partition(cursor, table, name)
+    cursor.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(names)}")
+    return [f'{table}.{name}' for name in names]
+
+
+def _archive_partition(cursor, table, name):
+    # swaps the partition's rows with an empty table of the same columns (no rows are copied). a partition found
+    # empty was already swapped by a run which failed before dropping it - swapping again would bring it back
+    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {table} PARTITION ({name}))')
+    if not cursor.fetchone()[0]:
+        return
+    archive_table = f'{table}_archive_{name[1:].lstrip("_")}'
+    cursor.execute('SHOW TABLES LIKE %s', (archive_table,))
+    if not cursor.fetchone():
+        cursor.execute(f'CREATE TABLE {archive_table} LIKE {table}')
+        cursor.execute(f'ALTER TABLE {archive_table} REMOVE PARTITIONING')
+    cursor.execute(f'ALTER TABLE {table} EXCHANGE PARTITION {name} WITH TABLE {archive_table}')
@@ -0,0 +1,29 @@
+import json
+import resources
+import retention
+import tracing
+
+
+@tracing.traced
+def maintain_lambda(event, context):
+    # runs daily: partitions the next months of the messages tables and drops (or archives) the expired ones
+    global result
+
+    try:
+        created, expired = retention.maintain(resources.get_db_connection())
+
+        # output
+        result = {
+            'statusCode': 200,
+            'body': json.dumps(f'success in maintaining partitions: created {created}, expired {expired}')
+        }
+
+        return result
+
+    except Exception as e:
+        resources.discard_if_broken(e)
+        result = {
+            'statusCode': 500,
+            'body': json.dumps(f"error in maintaining partitions: {e}")
+        }
+        return result
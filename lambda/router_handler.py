@@ -0,0 +1,33 @@
+import json
+import group_handler
+import read_handler
+import user_handler
+
+# single-function mode (pulumi config single_function): one lambda serves every endpoint, so all the requests
+# share its warm containers and their connections. the same handlers are deployed one per lambda otherwise
+routes = {
+    '/register': user_handler.register_lambda,
+    '/block': user_handler.block_lambda,
+    '/send': user_handler.send_lambda,
+    '/send_batch': user_handler.send_batch_lambda,
+    '/create_group': group_handler.create_group_lambda,
+    '/update_group': group_handler.update_group_lambda,
+    '/send_group': group_handler.send_group_lambda,
+    '/read_messages': read_handler.read_messages_lambda,
+    '/inbox_summary': read_handler.inbox_summary_lambda,
+}
+
+
+def route_lambda(event, context):
+    global result
+
+    # the resource is the route's path (as declared in the api, without the stage)
+    handler = routes.get(event.get('resource') or event.get('path'))
+    if handler is None:
+        result = {
+            'statusCode': 404,
+            'body': json.dumps(f"error in routing: no endpoint {event.get('path')}")
+        }
+        return result
+
+    return handler(event, context)
@@ -0,0 +1,205 @@
+import pymysql
+import retention
+from pymysql.constants import ER
+
+db_name = 'mydatabase'
+schema_version_table = 'schema_version'
+migration_lock = f'{db_name}.schema_migration'
+migration_lock_timeout_seconds = 30
+
+columns_query = """
+SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s
+"""
+
+indexes_query = """
+SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND INDEX_NAME=%s
+"""
+
+
+def _create_index(table, index, columns):
+    # a step of migration 2, skipped if the index exists (created by a run which failed on a later one)
+    def create_index(cursor):
+        cursor.execute(indexes_query, (table, index))
+        if not cursor.fetchall():
+            cursor.execute(f'CREATE INDEX {index} ON {table} ({columns})')
+    return create_index
+
+
+def _message_ids_to_bytes(table):
+    # migration 4 of one table. DDL is not transactional, so a run which failed midway leaves the table between
+    # two steps - each step is skipped once done, and the migration can run again
+    def migrate_table(cursor):
+        cursor.execute(columns_query, (table,))
+        columns = {name: data_type.lower() for name, data_type in cursor.fetchall()}
+        if columns.get('message_id') == 'binary':
+            return
+        if 'message_id_bytes' not in columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN message_id_bytes BINARY(16)')
+        if 'message_id' in columns:
+            cursor.execute(f"UPDATE {table} SET message_id_bytes=UNHEX(REPLACE(message_id, '-', ''))")
+            cursor.execute(f'ALTER TABLE {table} DROP PRIMARY KEY, DROP COLUMN message_id')
+        cursor.execute(f'ALTER TABLE {table} CHANGE message_id_bytes message_id BINARY(16) NOT NULL FIRST, '
+                       'ADD PRIMARY KEY (message_id)')
+    return migrate_table
+
+
+def _blocks_to_pairs(cursor):
+    # migration 5, which can run again like _message_ids_to_bytes: the last step replaces the old column (and
+    # the primary key) at once, so the migration is done once it is gone
+    cursor.execute(columns_query, ('blocks_table',))
+    columns = {name for name, _ in cursor.fetchall()}
+    if 'blocking_blocked_pair' not in columns:
+        return
+    if 'blocking_user_id' not in columns:
+        cursor.execute('ALTER TABLE blocks_table ADD COLUMN blocking_user_id VARCHAR(255), '
+                       'ADD COLUMN blocked_user_id VARCHAR(255)')
+    cursor.execute("UPDATE blocks_table SET blocking_user_id=SUBSTRING_INDEX(blocking_blocked_pair, ',', 1), "
+                   "blocked_user_id=SUBSTRING_INDEX(blocking_blocked_pair, ',', -1)")
+    cursor.execute('ALTER TABLE blocks_table DROP PRIMARY KEY, DROP COLUMN blocking_blocked_pair, '
+                   'MODIFY blocking_user_id VARCHAR(255) NOT NULL, MODIFY blocked_user_id VARCHAR(255) NOT NULL, '
+                   'ADD PRIMARY KEY (blocking_user_id, blocked_user_id)')
+
+
+# every migration runs once, in order, and is recorded as a row in the schema_version table. a step is a statement,
+# or a function of the cursor for the ones which depend on the database (or the date).
+# never edit a migration that has been deployed - append a new one instead.
+migrations = [
+    (1, [
+        # the tables the handlers used to create on every request (IF NOT EXISTS keeps it safe for existing DBs)
+        'CREATE TABLE IF NOT EXISTS users_table (user_id VARCHAR(255) PRIMARY KEY, user_name VARCHAR(255))',
+        'CREATE TABLE IF NOT EXISTS blocks_table (blocking_blocked_pair VARCHAR(255) PRIMARY KEY)',
+        """
+        CREATE TABLE IF NOT EXISTS user_messages_table (
+        message_id VARCHAR(255) PRIMARY KEY,
+        sending_user_id VARCHAR(255),
+        receiving_user_id VARCHAR(255),
+        message_text VARCHAR(255),
+        timestamp TIMESTAMP
+        )
+        """,
+        'CREATE TABLE IF NOT EXISTS groups_table (group_id VARCHAR(255) PRIMARY KEY, group_name VARCHAR(255))',
+        """
+        CREATE TABLE IF NOT EXISTS group_members_table (
+        group_id VARCHAR(255),
+        user_id VARCHAR(255),
+        PRIMARY KEY (group_id, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS group_messages_table (
+        message_id VARCHAR(255) PRIMARY KEY,
+        sending_user_id VARCHAR(255),
+        group_id VARCHAR(255),
+        message_text VARCHAR(255),
+        timestamp TIMESTAMP
+        )
+        """,
+    ]),
+    (2, [
+        # the read_messages query filters by receiver / group and by time, and joins the groups of a user
+        _create_index('user_messages_table', 'receiving_user_timestamp_idx', 'receiving_user_id, timestamp'),
+        _create_index('group_messages_table', 'group_timestamp_idx', 'group_id, timestamp'),
+        _create_index('group_members_table', 'user_idx', 'user_id'),
+    ]),
+    (3, [
+        # microseconds, like the cache - the DB only fills the gap before the oldest cached message
+        'ALTER TABLE user_messages_table MODIFY timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)',
+        'ALTER TABLE group_messages_table MODIFY timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)',
+    ]),
+    (4, [
+        # the message ids (time-ordered, see ids.py) as 16 bytes instead of a 36 characters string. they are
+        # internal - the API never returns them - so the existing (uuid4) ones are converted in place
+        _message_ids_to_bytes('user_messages_table'),
+        _message_ids_to_bytes('group_messages_table'),
+    ]),
+    (5, [
+        # a block is a (blocking user, blocked user) pair instead of a 'blocking,blocked' string. the primary key
+        # also serves reading the whole block list of a user (blocks.load_block_lists)
+        _blocks_to_pairs,
+    ]),
+    (6, [
+        # the number of a message in its receiver's sequence (see sequence.py). the messages sent before have
+        # none. unique, so two messages can never get the same number (and reading after a number is a range)
+        'ALTER TABLE user_messages_table ADD COLUMN seq BIGINT UNSIGNED NULL, '
+        'ADD UNIQUE INDEX receiving_user_seq_idx (receiving_user_id, seq)',
+    ]),
+    (7, [
+        # monthly partitions by the time of sending (see retention.py). every unique key of a partitioned table has
+        # to include the partitioning column, so the timestamp joins them: a message id is still unique (the ids
+        # are time-ordered), a seq only per timestamp (see sequence.reserve). and RANGE COLUMNS partitions a
+        # DATETIME but not a TIMESTAMP: the same values, without the time zone conversions (the sessions are in
+        # UTC) and the year 2038 limit
+        'ALTER TABLE user_messages_table MODIFY timestamp DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), '
+        'DROP PRIMARY KEY, ADD PRIMARY KEY (message_id, timestamp), '
+        'DROP INDEX receiving_user_seq_idx, ADD UNIQUE INDEX receiving_user_seq_idx (receiving_user_id, seq, timestamp)',
+        'ALTER TABLE group_messages_table MODIFY timestamp DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), '
+        'DROP PRIMARY KEY, ADD PRIMARY KEY (message_id, timestamp)',
+        retention.partition_tables,
+    ]),
+]
+
+# set once the schema of this container's database is known to be up to date
+_schema_ready = False
+
+
+def latest_version():
+    return migrations[-1][0]
+
+
+def create_database(connection):
+    # only needed on the very first deployment, before the database exists
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE IF NOT EXISTS {db_name}')
+
+
+def current_version(cursor):
+    try:
+        cursor.execute(f'SELECT MAX(version) FROM {schema_version_table}')
+    except pymysql.ProgrammingError as e:
+        if e.args[0] != ER.NO_SUCH_TABLE:
+            raise
+        return 0
+    return cursor.fetchone()[0] or 0
+
+
+def migrate(connection):
+    # apply the pending migrations, returns the schema version of the database
+    with connection.cursor() as cursor:
+        if current_version(cursor) >= latest_version():
+            return latest_version()
+
+        # several cold starts may race here - only one of them migrates
+        cursor.execute('SELECT GET_LOCK(%s, %s)', (migration_lock, migration_lock_timeout_seconds))
+        if not cursor.fetchone()[0]:
+            raise RuntimeError('timed out waiting for the schema migration lock')
+        try:
+            cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {schema_version_table} (
+            version INT PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            version = current_version(cursor)
+            for migration_version, statements in migrations:
+                if migration_version <= version:
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement)
+                cursor.execute(f'INSERT INTO {schema_version_table} (version) VALUES (%s)', (migration_version,))
+                version = migration_version
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (migration_lock,))
+
+    return version
+
+
+def ensure_schema(connection):
+    # called for every new connection, but checks the database only once per container
+    global _schema_ready
+
+    if not _schema_ready:
+        migrate(connection)
+        _schema_ready = True
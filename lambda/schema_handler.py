@@ -0,0 +1,30 @@
+import json
+import resources
+import schema
+import tracing
+
+
+@tracing.traced
+def migrate_lambda(event, context):
+    # invoked on deploy, so the first user requests don't pay for the migrations
+    global result
+
+    try:
+        connection = resources.get_db_connection()
+        version = schema.migrate(connection)
+
+        # output
+        result = {
+            'statusCode': 200,
+            'body': json.dumps(f'success in migrating! schema version: {version}')
+        }
+
+        return result
+
+    except Exception as e:
+        resources.discard_if_broken(e)
+        result = {
+            'statusCode': 500,
+            'body': json.dumps(f"error in migrating: {e}")
+        }
+        return result
@@ -0,0 +1,147 @@
+import cache
+import codec
+
+# every message to a user gets the next number of the receiver's sequence (1, 2, 3, ... without gaps), stored
+# with the message in the DB and in the cache. read_messages with after_seq returns exactly the messages after
+# that number - no clocks are compared. group messages are stored once per group, so they are not numbered
+user_messages_table = 'user_messages_table'
+
+# a number missing for this long is skipped: its send failed after taking it. until then it may still be in
+# flight (taken, but not inserted or cached yet), and the messages after it wait for it
+settle_seconds = 10
+
+# the newest seq of each of the users' messages in the DB (a user without numbered messages has no row)
+db_lasts_query = f"""
+SELECT receiving_user_id, MAX(seq) FROM {user_messages_table} WHERE receiving_user_id IN %s
+GROUP BY receiving_user_id
+"""
+
+# INCRBY of a counter which exists, else nil - a missing counter is seeded first (see reserve)
+incrby_existing_script = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return false
+"""
+
+# the user's messages after a seq, served by the unique index of schema migration 6 (in every monthly partition -
+# the query can't tell which months hold them)
+db_read_query = f"""
+SELECT seq, timestamp, sending_user_id, message_text FROM {user_messages_table}
+WHERE receiving_user_id=%s AND seq > %s
+"""
+
+
+def counter_key(user_id):
+    # the user's last seq. never expires - when redis loses it, it continues after the DB's (see reserve)
+    return f'seq:{user_id}'
+
+
+def sequenced_key(user_id):
+    # the user's newest messages scored by their seq (the same records as the messages:{user id} set)
+    return f'sequenced:{user_id}'
+
+
+def pending_key(user_id):
+    # in write-behind mode, the user's messages not drained into the DB yet, scored by their seq
+    return f'pending_seq:{user_id}'
+
+
+def reserve(connection, client, counts):
+    """Reserve the next counts[user_id] numbers of each user's sequence, returns user id -> the first of them.
+
+    A single round trip to redis. A counter which does not exist (the user's first message - or redis lost it)
+    is seeded with the newest seq of the user in the DB before any number is taken from it: sends racing on it
+    all seed it with the same value, only the first one sets it, and each then takes its own numbers after it.
+    All the missing counters are seeded at once - one query and one more round trip, however many there are.
+    (Since the tables are partitioned by time (schema migration 7) the unique index no longer rejects a number
+    taken twice, unless at the same timestamp - so the counter must never hand one out twice.)
+    """
+    if not counts:
+        return {}
+    user_ids = list(counts)
+    with client.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.eval(incrby_existing_script, 1, counter_key(user_id), counts[user_id])
+        lasts = dict(zip(user_ids, pipe.execute()))
+
+    missing = [user_id for user_id, last in lasts.items() if last is None]
+    if missing:
+        with connection.cursor() as cursor:
+            cursor.execute(db_lasts_query, (missing,))
+            db_lasts = dict(cursor.fetchall())
+        with client.pipeline(transaction=False) as pipe:
+            for user_id in missing:
+                pipe.set(counter_key(user_id), db_lasts.get(user_id) or 0, nx=True)
+                pipe.incrby(counter_key(user_id), counts[user_id])
+            lasts.update(zip(missing, pipe.execute()[1::2]))
+
+    return {user_id: last - counts[user_id] + 1 for user_id, last in lasts.items()}
+
+
+def queue(pipe, user_id, seq, value):
+    # queue caching a message by its seq on pipe (within the transaction which caches the message)
+    key = sequenced_key(user_id)
+    pipe.zadd(key, {value: seq})
+    pipe.zremrangebyrank(key, 0, -cache.cache_length - 1)
+    pipe.expire(key, cache.ttl_seconds)
+
+
+def read_after(client, user_id, after_seq):
+    """The user's cached messages after after_seq and whether they are all of them (as far as numbers were taken).
+
+    The messages are (seq, timestamp_us, sending_user_id, message_text) tuples, newest first. They are all of
+    them when the cache holds every number up to the user's last one. Without the user's counter (no message
+    was ever numbered - or redis lost it) only the DB knows.
+    """
+    with client.pipeline(transaction=False) as pipe:
+        pipe.get(counter_key(user_id))
+        pipe.zrevrangebyscore(sequenced_key(user_id), '+inf', f'({after_seq}', withscores=True,
+                              score_cast_func=int)
+        last_seq, records = pipe.execute()
+
+    messages = _decode(records)
+    return messages, last_seq is not None and len(messages) == int(last_seq) - after_seq
+
+
+def read_pending_after(client, user_id, after_seq):
+    # in write-behind mode, the user's messages after after_seq which are not in the DB yet (as read_after)
+    return _decode(client.zrangebyscore(pending_key(user_id), f'({after_seq}', '+inf', withscores=True,
+                                        score_cast_func=int))
+
+
+def write_back(client, user_id, messages):
+    # cache the newest of the messages read from the DB, so the next read after the same seq hits the cache
+    newest = sorted(messages, reverse=True)[:cache.cache_length]
+    if not newest:
+        return
+    key = sequenced_key(user_id)
+    with client.pipeline(transaction=True) as pipe:
+        pipe.zadd(key, {codec.encode(timestamp_us, 0, sending_user_id, message_text): seq
+                        for seq, timestamp_us, sending_user_id, message_text in newest})
+        pipe.zremrangebyrank(key, 0, -cache.cache_length - 1)
+        pipe.expire(key, cache.ttl_seconds)
+        pipe.execute()
+
+
+def contiguous(messages, after_seq, now_us):
+    """The messages (newest first) up to the first number still missing, so a reader never skips one in flight.
+
+    A number is skipped once a message after it is settle_seconds old (the send which took it failed).
+    """
+    expected = after_seq + 1
+    result = []
+    for message in reversed(messages):
+        if message[0] != expected and now_us - message[1] < settle_seconds * 1_000_000:
+            break
+        result.append(message)
+        expected = message[0] + 1
+    result.reverse()
+    return result
+
+
+def _decode(records):
+    # (record, seq) pairs into (seq, timestamp_us, sending_user_id, message_text) tuples
+    return [(seq, timestamp_us, sending_user_id, message_text)
+            for (timestamp_us, _, sending_user_id, message_text), (_, seq)
+            in zip(codec.decode_many([record for record, _ in records]), records)]
@@ -0,0 +1,99 @@
+import functools
+import json
+import os
+import sys
+import time
+import pymysql
+import redis
+
+# per-phase latency of the handlers: with TRACING=1 every invocation logs one line of CloudWatch embedded
+# metric format (EMF) - the milliseconds of each phase and the DB / Redis round trips - which CloudWatch
+# turns into metrics by handler. disabled, the handlers are not even wrapped and a mark is a single check
+enabled = os.environ.get('TRACING', '0') == '1'
+namespace = 'messaging'
+
+# the invocation being traced (one at a time per container)
+_invocation = None
+
+
+def traced(handler):
+    # decorator of the *_lambda handlers
+    if not enabled:
+        return handler
+
+    name = handler.__name__.removesuffix('_lambda')
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _invocation
+
+        _invocation = {'phases': {}, 'db': 0, 'cache': 0, 'start': time.perf_counter()}
+        _invocation['last'] = _invocation['start']
+        result = None
+        try:
+            result = handler(event, context)
+            return result
+        finally:
+            invocation, _invocation = _invocation, None
+            _emit(name, invocation, result, context)
+
+    return wrapper
+
+
+def mark(phase):
+    # ends a phase: the time since the former mark (or since the start of the invocation) is the phase's
+    if _invocation is None:
+        return
+    now = time.perf_counter()
+    phases = _invocation['phases']
+    phases[phase] = phases.get(phase, 0.0) + now - _invocation['last']
+    _invocation['last'] = now
+
+
+def count_db(n=1):
+    if _invocation is not None:
+        _invocation['db'] += n
+
+
+def count_cache(n=1):
+    if _invocation is not None:
+        _invocation['cache'] += n
+
+
+def _emit(name, invocation, result, context):
+    total = time.perf_counter() - invocation['start']
+    values = {f'{phase}_ms': round(seconds * 1000, 3) for phase, seconds in invocation['phases'].items()}
+    values['total_ms'] = round(total * 1000, 3)
+    metrics = [{'Name': metric, 'Unit': 'Milliseconds'} for metric in values]
+    values['db_round_trips'] = invocation['db']
+    values['cache_round_trips'] = invocation['cache']
+    metrics += [{'Name': 'db_round_trips', 'Unit': 'Count'}, {'Name': 'cache_round_trips', 'Unit': 'Count'}]
+
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [['handler']], 'Metrics': metrics}]
+        },
+        'handler': name,
+        # properties only (searchable in the logs, not metrics)
+        'status_code': result.get('statusCode') if isinstance(result, dict) else None,
+        'request_id': getattr(context, 'aws_request_id', None),
+        **values
+    }
+    sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+# the round trips are counted by the drivers - resources uses these classes only when tracing is enabled
+
+class CountingCursor(pymysql.cursors.Cursor):
+    # every statement sent (executemany sends its multi-row INSERTs through execute as well)
+    def execute(self, query, args=None):
+        count_db()
+        return super().execute(query, args)
+
+
+class CountingConnection(redis.Connection):
+    # a command, or a whole pipeline, is sent in one go
+    def send_packed_command(self, command, check_health=True):
+        count_cache()
+        return super().send_packed_command(command, check_health)
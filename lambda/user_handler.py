@@ -1,16 +1,24 @@
 import json
-import uuid
+from collections import Counter
 from datetime import datetime
-import os
-import redis
-import pymysql
+import blocks
+import cache
+import codec
+import ids
+import outbox
+import resources
+import sequence
+import tracing
+
+max_batch_size = 1000  # messages per send_batch
+message_keys = ('sending_user_id', 'receiving_user_id', 'message_text')  # of each message of a send_batch
 
 users_table = 'users_table'
 blocks_table = 'blocks_table'
 user_messages_table = 'user_messages_table'
-cache_length = 20
 
 
+@tracing.traced
 def register_lambda(event, context):
     global result
 
@@ -18,24 +26,16 @@ def register_lambda(event, context):
         # parse input
         user_name = event['queryStringParameters']['user_name']
         # user_number = event['queryStringParameters']['user_number']
-        user_id = str(uuid.uuid4())
+        user_id = ids.new_id()
+        tracing.mark('parse')
 
         # update db
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASS']
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                # create table
-                cursor.execute(f'CREATE DATABASE IF NOT EXISTS mydatabase;')
-                cursor.execute("USE mydatabase")
-                cursor.execute(
-                    f'CREATE TABLE IF NOT EXISTS {users_table} (user_id VARCHAR(255) PRIMARY KEY, user_name VARCHAR(255));')
-                # record in table
-                cursor.execute(f"INSERT INTO {users_table} (user_id, user_name) VALUES ('{user_id}', '{user_name}');")
-            connection.commit()
+        connection = resources.get_db_connection()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            # record in table
+            cursor.execute(f"INSERT INTO {users_table} (user_id, user_name) VALUES ('{user_id}', '{user_name}');")
+        tracing.mark('insert')
 
         # output
         result = {
@@ -46,6 +46,7 @@ def register_lambda(event, context):
         return result
 
     except Exception as e:
+        resources.discard_if_broken(e)
         result = {
             'statusCode': 500,
             'body': json.dumps(f"error in registering: {e}")
@@ -53,6 +54,7 @@ def register_lambda(event, context):
         return result
 
 
+@tracing.traced
 def block_lambda(event, context):
     global result
 
@@ -61,32 +63,32 @@ def block_lambda(event, context):
         blocking_user_id = event['queryStringParameters']['blocking_user_id']
         blocked_user_id = event['queryStringParameters']['blocked_user_id']
         to_block = bool(int(event['queryStringParameters']['to_block']))
-        blocking_blocked_pair = "'" + blocking_user_id + ',' + blocked_user_id + "'"
+        tracing.mark('parse')
 
         # update db
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASS']
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                # create table
-                cursor.execute(f'CREATE DATABASE IF NOT EXISTS mydatabase;')
-                cursor.execute("USE mydatabase")
-                cursor.execute(
-                    f'CREATE TABLE IF NOT EXISTS {blocks_table} (blocking_blocked_pair VARCHAR(255) PRIMARY KEY);')
-                # record in table
-                if to_block:
-                    # in case of blocking - add it to the table
-                    cursor.execute(
-                        f"INSERT INTO {blocks_table} (blocking_blocked_pair) VALUES ({blocking_blocked_pair});")
-                    action = 'user has been blocked'
-                else:
-                    # in case of unblocking - remove it from the table
-                    cursor.execute(f"DELETE FROM {blocks_table} WHERE blocking_blocked_pair={blocking_blocked_pair};")
-                    action = 'user has been unblocked'
-            connection.commit()
+        connection = resources.get_db_connection()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            # record in table
+            if to_block:
+                # in case of blocking - add it to the table
+                cursor.execute(f"INSERT INTO {blocks_table} (blocking_user_id, blocked_user_id) VALUES (%s, %s);",
+                               (blocking_user_id, blocked_user_id))
+                action = 'user has been blocked'
+            else:
+                # in case of unblocking - remove it from the table
+                cursor.execute(f"DELETE FROM {blocks_table} WHERE blocking_user_id=%s AND blocked_user_id=%s;",
+                               (blocking_user_id, blocked_user_id))
+                action = 'user has been unblocked'
+        tracing.mark('db')
+
+        # update the block list in cache
+        cache_client = resources.get_cache_client()
+        if to_block:
+            blocks.add_block(cache_client, blocking_user_id, blocked_user_id)
+        else:
+            blocks.remove_block(cache_client, blocking_user_id, blocked_user_id)
+        tracing.mark('cache')
 
         # output
         result = {
@@ -97,6 +99,7 @@ def block_lambda(event, context):
         return result
 
     except Exception as e:
+        resources.discard_if_broken(e)
         result = {
             'statusCode': 500,
             'body': json.dumps(f"error in (un)blocking: {e}")
@@ -104,6 +107,7 @@ def block_lambda(event, context):
         return result
 
 
+@tracing.traced
 def send_lambda(event, context):
     global result
 
@@ -112,65 +116,64 @@ def send_lambda(event, context):
         sending_user_id = event['queryStringParameters']['sending_user_id']
         receiving_user_id = event['queryStringParameters']['receiving_user_id']
         message_text = event['queryStringParameters']['message_text']
+        too_long = outbox.too_long({'sending_user_id': sending_user_id, 'receiving_user_id': receiving_user_id,
+                                    'message_text': message_text})
+        if too_long:
+            result = {
+                'statusCode': 400,
+                'body': json.dumps(f'{too_long} is longer than {outbox.max_column_length} characters')
+            }
+            return result
+        tracing.mark('parse')
 
         # update db
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASS']
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                # create table
-                cursor.execute(f'CREATE DATABASE IF NOT EXISTS mydatabase;')
-                cursor.execute("USE mydatabase")
-                cursor.execute(f"""
-                CREATE TABLE IF NOT EXISTS {user_messages_table} (
-                message_id VARCHAR(255) PRIMARY KEY,
-                sending_user_id VARCHAR(255),
-                receiving_user_id VARCHAR(255),
-                message_text VARCHAR(255),
-                timestamp TIMESTAMP
-                );
-                """)
-
-                # check blocking
-                blocking_blocked_pair = "'" + receiving_user_id + ',' + sending_user_id + "'"
-                cursor.execute(f"SELECT * FROM {blocks_table} WHERE blocking_blocked_pair={blocking_blocked_pair};")
-                records = cursor.fetchall()
-                if records:
-                    result = {
-                        'statusCode': 400,
-                        'body': json.dumps('receiver has blocked the sender')
-                    }
-                    return result
-
-                # message details
-                message_id = str(uuid.uuid4())
-                message_timestamp = datetime.now()
+        connection = resources.get_db_connection()
+        cache_client = resources.get_cache_client()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            # check blocking (in the cache, unless it is cold)
+            blocked = blocks.is_blocked(cache_client, receiving_user_id, sending_user_id)
+            if blocked is None:
+                # read the receiver's whole block list (and cache it for the next messages to the receiver)
+                block_lists = blocks.load_block_lists(connection, cache_client, [receiving_user_id])
+                blocked = sending_user_id in block_lists[receiving_user_id]
+            tracing.mark('blocks')
+            if blocked:
+                result = {
+                    'statusCode': 400,
+                    'body': json.dumps('receiver has blocked the sender')
+                }
+                return result
 
-                # record
+            # message details (the number of the message in the receiver's sequence, see sequence.py)
+            message_id = ids.new_id()
+            message_timestamp = datetime.now()
+            # the cached record - encoded before anything is stored, so a message which can't be cached is not sent
+            is_group = 0
+            score = codec.epoch_us(message_timestamp)
+            value = codec.encode(score, is_group, sending_user_id, message_text)
+            seq = sequence.reserve(connection, cache_client, {receiving_user_id: 1})[receiving_user_id]
+            tracing.mark('sequence')
+
+            # record (in write-behind mode, the drainer records it)
+            if not outbox.write_behind:
                 cursor.execute(f"""
                 INSERT INTO {user_messages_table} 
-                (message_id, sending_user_id, receiving_user_id, message_text, timestamp) VALUES 
-                ('{message_id}', '{sending_user_id}', '{receiving_user_id}', 
-                '{message_text}', '{str(message_timestamp)}');
-                """)
-
-            connection.commit()
-
-        # send to cache
-        redis_host = os.environ['REDIS_HOST']
-        cache_client = redis.Redis(host=redis_host, port=6379, db=0)
-        is_group = 0
-        value = f'{str(message_timestamp)}:: {is_group} {sending_user_id}:: {message_text}'
-        # cache_client.set(receiving_user_id, value)
-        # cache_client.delete(receiving_user_id)
-        # push the new message
-        cache_client.lpush(receiving_user_id, value)
-        # remove the oldest message
-        if cache_client.llen(receiving_user_id) > cache_length:
-            cache_client.rpop(receiving_user_id)
+                (message_id, sending_user_id, receiving_user_id, message_text, timestamp, seq) VALUES 
+                (%s, %s, %s, %s, %s, %s);
+                """, (ids.to_bytes(message_id), sending_user_id, receiving_user_id, message_text, message_timestamp,
+                      seq))
+        tracing.mark('insert')
+
+        # send to cache, by time and by seq, count it as unread (and in write-behind mode send it to the stream of
+        # the drainer), in the same transaction
+        def extra(pipe):
+            if outbox.write_behind:
+                outbox.queue(pipe, message_id, is_group, sending_user_id, receiving_user_id, message_text, score, seq)
+            sequence.queue(pipe, receiving_user_id, seq, value)
+            cache.count_unread(pipe, [receiving_user_id], f'user:{sending_user_id}')
+        cache.append_messages(cache_client, [receiving_user_id], value, score, extra)
+        tracing.mark('cache')
 
         # output
         result = {
@@ -181,8 +184,152 @@ def send_lambda(event, context):
         return result
 
     except Exception as e:
+        resources.discard_if_broken(e)
         result = {
             'statusCode': 500,
             'body': json.dumps(f"error in sending: {e}")
         }
         return result
+
+
+@tracing.traced
+def send_batch_lambda(event, context):
+    # send many messages at once: the body is a JSON array of
+    # {"sending_user_id": ..., "receiving_user_id": ..., "message_text": ...} objects
+    global result
+
+    try:
+        # parse input
+        try:
+            messages = json.loads(event.get('body') or '')
+        except ValueError:
+            messages = None
+        if not isinstance(messages, list) or not 0 < len(messages) <= max_batch_size:
+            result = {
+                'statusCode': 400,
+                'body': json.dumps(f'expected a JSON array of 1 to {max_batch_size} messages')
+            }
+            return result
+        for index, message in enumerate(messages):
+            if not isinstance(message, dict) or not all(isinstance(message.get(key), str) for key in message_keys):
+                result = {
+                    'statusCode': 400,
+                    'body': json.dumps(f'message {index}: expected an object with the strings '
+                                       f'{", ".join(message_keys)}')
+                }
+                return result
+            too_long = outbox.too_long({key: message[key] for key in message_keys})
+            if too_long:
+                result = {
+                    'statusCode': 400,
+                    'body': json.dumps(f'message {index}: {too_long} is longer than {outbox.max_column_length} '
+                                       f'characters')
+                }
+                return result
+        messages = [tuple(message[key] for key in message_keys) for message in messages]
+        tracing.mark('parse')
+
+        # update db
+        connection = resources.get_db_connection()
+        cache_client = resources.get_cache_client()
+        tracing.mark('db_connect')
+        with connection.cursor() as cursor:
+            # check blocking of all the pairs at once (in the cache, unless it is cold)
+            pairs = {(receiving_user_id, sending_user_id) for sending_user_id, receiving_user_id, _ in messages}
+            blocked = blocks.blocked_pairs(cache_client, pairs)
+            if blocked is None:
+                # read the receivers' whole block lists at once (and cache them)
+                block_lists = blocks.load_block_lists(connection, cache_client,
+                                                      [blocking_user_id for blocking_user_id, _ in pairs])
+                blocked = {(blocking_user_id, blocked_user_id) for blocking_user_id, blocked_user_id in pairs
+                           if blocked_user_id in block_lists[blocking_user_id]}
+            tracing.mark('blocks')
+
+            # message details (the blocked ones are skipped)
+            accepted = []
+            rejected = []
+            for index, (sending_user_id, receiving_user_id, message_text) in enumerate(messages):
+                if (receiving_user_id, sending_user_id) in blocked:
+                    rejected.append(index)
+                    continue
+                accepted.append((sending_user_id, receiving_user_id, message_text))
+            # the numbers of the messages in their receivers' sequences, reserved for all the receivers at once
+            next_seqs = sequence.reserve(connection, cache_client,
+                                         Counter(receiving_user_id for _, receiving_user_id, _ in accepted))
+            # with their cached records - encoded before anything is stored (see send_lambda)
+            is_group = 0
+            rows = []
+            deliveries = []
+            for sending_user_id, receiving_user_id, message_text in accepted:
+                seq = next_seqs[receiving_user_id]
+                next_seqs[receiving_user_id] += 1
+                message_timestamp = datetime.now()
+                rows.append((ids.new_id(), sending_user_id, receiving_user_id, message_text, message_timestamp, seq))
+                score = codec.epoch_us(message_timestamp)
+                deliveries.append((receiving_user_id, codec.encode(score, is_group, sending_user_id, message_text),
+                                   score))
+            tracing.mark('sequence')
+
+            # record (executemany sends a single multi-row INSERT. in write-behind mode, the drainer records them)
+            if rows and not outbox.write_behind:
+                cursor.executemany(f"""
+                INSERT INTO {user_messages_table} 
+                (message_id, sending_user_id, receiving_user_id, message_text, timestamp, seq) VALUES 
+                (%s, %s, %s, %s, %s, %s)
+                """, [(ids.to_bytes(row[0]),) + row[1:] for row in rows])
+        tracing.mark('insert')
+
+        # send to cache, by time and by seq, count it as unread (and in write-behind mode send it to the stream of
+        # the drainer), in the same transaction
+        def extra(pipe):
+            for row, (_, value, score) in zip(rows, deliveries):
+                message_id, sending_user_id, receiving_user_id, message_text, _, seq = row
+                if outbox.write_behind:
+                    outbox.queue(pipe, message_id, is_group, sending_user_id, receiving_user_id, message_text, score,
+                                 seq)
+                sequence.queue(pipe, receiving_user_id, seq, value)
+                cache.count_unread(pipe, [receiving_user_id], f'user:{sending_user_id}')
+        cache.append_many(cache_client, deliveries, extra)
+        tracing.mark('cache')
+
+        # output
+        result = {
+            'statusCode': 200,
+            'body': json.dumps(f'success in sending batch: {len(rows)} sent, '
+                               f'blocked by the receiver (indexes): {rejected}')
+        }
+
+        return result
+
+    except Exception as e:
+        resources.discard_if_broken(e)
+        result = {
+            'statusCode': 500,
+            'body': json.dumps(f"error in sending batch: {e}")
+        }
+        return result
+
+
+@tracing.traced
+def rebuild_blocks_lambda(event, context):
+    # reloads the block list in cache from the db (invoked on deploy, or when the cache was lost)
+    global result
+
+    try:
+        count = blocks.rebuild(resources.get_db_connection(), resources.get_cache_client())
+
+        # output
+        result = {
+            'statusCode': 200,
+            'body': json.dumps(f'success in rebuilding the block list: {count} blocks')
+        }
+
+        return result
+
+    except Exception as e:
+        resources.discard_if_broken(e)
+        result = {
+            'statusCode': 500,
+            'body': json.dumps(f"error in rebuilding the block list: {e}")
+        }
+        return result